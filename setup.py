@@ -21,8 +21,21 @@ setup(name='watchtower.alert',
       license='UCSD-Non-Commerical-Academic',
       packages=find_packages(),
       include_package_data=True,
-      entry_points={'console_scripts': [
-          'watchtower-alert=watchtower.alert.consumer:main'
-      ]},
-      install_requires=install_requires
+      entry_points={
+          'console_scripts': [
+              'watchtower-alert=watchtower.alert.consumer:main'
+          ],
+          # consumer plugins, see watchtower.alert.consumers
+          'watchtower.alert.consumers': [
+              'log=watchtower.alert.consumers.log:LogConsumer',
+              'database=watchtower.alert.consumers.database:DatabaseConsumer',
+              'timeseries=watchtower.alert.consumers.timeseries:TimeseriesConsumer',
+              'slack=watchtower.alert.consumers.slack:SlackConsumer',
+          ],
+      },
+      install_requires=install_requires,
+      extras_require={
+          # faster alert decoding, see watchtower.alert.codec
+          'fast': ['msgspec', 'orjson'],
+      }
       )
@@ -0,0 +1,188 @@
+import asyncio
+import concurrent.futures
+import logging
+import time
+
+
+def is_async(plugin):
+    return asyncio.iscoroutinefunction(plugin.handle_alert)
+
+
+class SyncConsumerAdapter:
+    """Runs a synchronous (AbstractConsumer) plugin under the asyncio runtime.
+
+    Each call is handed to a thread dedicated to the plugin as soon as it is
+    made, and an awaitable for its result is returned. The plugin is thus
+    only ever called from that one thread, and sees alerts and timers in
+    the order the runtime dispatched them, as it would when run inline.
+    """
+
+    def __init__(self, name, plugin):
+        self.name = name
+        self.plugin = plugin
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix='plugin-%s' % name)
+
+    def __repr__(self):
+        return "SyncConsumerAdapter(%s)" % self.name
+
+    def _submit(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args)
+
+    def start(self):
+        return self._submit(self.plugin.start)
+
+    async def stop(self):
+        try:
+            await self._submit(self.plugin.stop)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    def handle_alert(self, alert):
+        return self._submit(self.plugin.handle_alert, alert)
+
+    def handle_alerts(self, alerts):
+        return self._submit(self.plugin.handle_alerts, alerts)
+
+    def handle_error(self, error):
+        return self._submit(self.plugin.handle_error, error)
+
+    def handle_timer(self, now):
+        return self._submit(self.plugin.handle_timer, now)
+
+
+class AsyncRuntime:
+    """Runs a Consumer's plugins on an asyncio event loop.
+
+    Kafka is polled from a dedicated thread, and each message (or batch, if
+    batch_size > 1) is handed to every alert plugin at once, so plugins wait
+    on I/O concurrently. Up to max_in_flight messages/batches are handled
+    concurrently, after which polling waits for one of them to finish.
+    Synchronous plugins run through a SyncConsumerAdapter. Timers are
+    awaited from the main loop, as in inline execution.
+    """
+
+    def __init__(self, consumer, max_in_flight):
+        self.consumer = consumer
+        self.max_in_flight = max_in_flight
+        # name => plugin with awaitable handlers
+        self.plugins = {}
+        for name, plugin in consumer.consumer_instances.items():
+            if not is_async(plugin):
+                plugin = SyncConsumerAdapter(name, plugin)
+            self.plugins[name] = plugin
+        self.alert_plugins = [(name, self.plugins[name])
+                              for name in consumer.config['alert_consumers']]
+
+        self._slots = None
+        self._tasks = set()
+        self._poller = None
+        self.handled = 0
+        self.errors = 0
+
+    def stats(self):
+        return {
+            'in_flight': len(self._tasks),
+            'handled': self.handled,
+            'errors': self.errors,
+        }
+
+    async def run(self):
+        consumer = self.consumer
+        loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._poller = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix='kafka-poll')
+        for name, plugin in self.plugins.items():
+            await plugin.start()
+        try:
+            while consumer.running:
+                # TIMERS
+                await self._handle_due_timers(time.time())
+
+                # ALERTS
+                msgs = await loop.run_in_executor(self._poller, consumer._poll)
+                good_msgs, fatal = consumer._check_msgs(msgs)
+                if good_msgs:
+                    await self._submit(good_msgs)
+                if consumer.offsets is not None:
+                    consumer.offsets.maybe_commit()
+                    consumer._check_failed()
+                if fatal:
+                    break
+        finally:
+            if self._tasks:
+                logging.info("Waiting for %d in-flight alerts"
+                             % len(self._tasks))
+                await asyncio.wait(list(self._tasks))
+            await self._stop_plugins()
+            self._poller.shutdown(wait=False)
+
+    async def _stop_plugins(self):
+        for name, plugin in self.plugins.items():
+            try:
+                await plugin.stop()
+            except Exception as e:
+                logging.error("Failed to stop plugin %s" % name)
+                logging.exception(e)
+
+    async def _handle_due_timers(self, now):
+        for name, when in self.consumer.timers.due(now):
+            if name in self.plugins:
+                await self._call(name, 'timer', self.plugins[name].handle_timer,
+                                 when)
+            else:
+                self.consumer._log_stats()
+                logging.debug("Async runtime stats: %s" % self.stats())
+
+    async def _submit(self, msgs):
+        ack = self.consumer._track(msgs)
+        alerts = [self.consumer._decode_alert(msg.value()) for msg in msgs]
+        alerts = [alert for alert in alerts if alert is not None]
+        if not alerts:
+            if ack is not None:
+                ack.complete()
+            return
+        await self._slots.acquire()
+        # the handlers are called (and sync plugins are handed the alerts)
+        # right away, in the order the messages were consumed
+        calls = []
+        for (name, plugin), plugin_alerts in zip(self.alert_plugins,
+                                                 self.consumer._route(alerts)):
+            if not plugin_alerts:
+                # routed away from this plugin
+                if ack is not None:
+                    ack.ack()
+            elif len(alerts) == 1:
+                calls.append((name, plugin.handle_alert(plugin_alerts[0])))
+            else:
+                calls.append((name, plugin.handle_alerts(plugin_alerts)))
+        task = asyncio.ensure_future(self._handle(calls, ack))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        self._slots.release()
+
+    async def _handle(self, calls, ack):
+        await asyncio.gather(*[self._await(name, 'alert', call, ack)
+                               for name, call in calls])
+        self.handled += 1
+
+    async def _await(self, name, kind, awaitable, ack=None):
+        try:
+            await awaitable
+        except Exception as e:
+            self.errors += 1
+            logging.error("Plugin '%s' failed to handle %s" % (name, kind))
+            logging.exception(e)
+            if ack is not None:
+                ack.fail()
+        else:
+            if ack is not None:
+                ack.handled(self.consumer.consumer_instances[name])
+
+    async def _call(self, name, kind, func, *args):
+        await self._await(name, kind, func(*args))
@@ -34,9 +34,11 @@
 # MODIFICATIONS.
 
 import json
-import requests
 import sys
 
+from . import codec
+from .entities import EntityCache, EntityClient, MISSING
+
 # Shut requests up
 import warnings
 warnings.filterwarnings('once', r'.*InsecurePlatformWarning.*')
@@ -45,8 +47,22 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 
 class Alert:
 
+    # alerts can carry thousands of violations, so avoid a __dict__ per
+    # object and a property call per attribute access
+    __slots__ = ('fqid', 'name', '_level', '_time', 'expression',
+                 'history_expression', 'method', '_violations',
+                 'violations_annotated')
+
     LEVELS = ['critical', 'warning', 'normal', 'error']
-    IODA_ENTITY_API = "https://api.ioda.inetintel.cc.gatech.edu/v2/entities"
+    IODA_ENTITY_API = EntityClient.defaults['api_url']
+
+    # process-wide cache of IODA entity metadata, and the (pooled) client
+    # used to fill it, shared by all alerts
+    entity_cache = EntityCache()
+    entity_client = EntityClient(cache=entity_cache)
+
+    # process-wide JSON decoder used by from_json
+    decoder = codec.get_decoder()
 
     def __init__(self, fqid, name, level, time, expression, history_expression,
                  method, violations=None):
@@ -66,10 +82,63 @@ class Alert:
 
     @classmethod
     def from_json(cls, json_str):
-        obj = json.loads(json_str)
-        # convert violations to objects
-        obj['violations'] = [Violation(**viol) for viol in obj['violations']]
-        return Alert(**obj)
+        """Build an alert from its JSON encoding, given as str or bytes"""
+        obj = cls.decoder.decode(json_str)
+        if cls.decoder.typed:
+            violations = [Violation.from_trusted(v.expression, v.condition,
+                                                 v.value, v.history_value,
+                                                 v.history, v.time, v.meta)
+                          for v in obj.violations]
+            return cls.from_trusted(obj.fqid, obj.name, obj.level, obj.time,
+                                    obj.expression, obj.history_expression,
+                                    obj.method, violations)
+        try:
+            violations = [Violation.from_dict(viol)
+                          for viol in obj['violations']]
+            return cls.from_trusted(obj['fqid'], obj['name'], obj['level'],
+                                    obj['time'], obj['expression'],
+                                    obj['history_expression'], obj['method'],
+                                    violations)
+        except KeyError as e:
+            raise TypeError('Alert is missing field %s' % e)
+
+    @classmethod
+    def from_trusted(cls, fqid, name, level, time, expression,
+                     history_expression, method, violations):
+        """Fast constructor for alerts whose violations are already known to
+        be Violation objects (e.g. built by from_json)."""
+        if level not in cls.LEVELS:
+            raise TypeError('Alert level must be one of %s' % cls.LEVELS)
+        if not isinstance(time, int):
+            raise TypeError('Alert time must be an integer (UTC epoch time)')
+        self = cls.__new__(cls)
+        self.fqid = fqid
+        self.name = name
+        self._level = level
+        self._time = time
+        self.expression = expression
+        self.history_expression = history_expression
+        self.method = method
+        self._violations = violations
+        self.violations_annotated = False
+        return self
+
+    @classmethod
+    def configure_decoder(cls, name):
+        cls.decoder = codec.get_decoder(name)
+        logging.info("Decoding alerts using %s" % cls.decoder.name)
+
+    @classmethod
+    def configure_entity_cache(cls, config):
+        cls.entity_cache.close()
+        cls.entity_cache = EntityCache.from_config(config)
+        cls.entity_client.cache = cls.entity_cache
+
+    @classmethod
+    def configure_entity_client(cls, config):
+        cls.entity_client.close()
+        cls.entity_client = EntityClient.from_config(config,
+                                                     cache=cls.entity_cache)
 
     def as_dict(self):
         return {
@@ -84,8 +153,42 @@ class Alert:
         }
 
     def annotate_violations(self):
-        if self.violations_annotated:
-            return
+        self.annotate_alerts([self])
+
+    @classmethod
+    def annotate_alerts(cls, alerts):
+        """Annotate the violations of several alerts at once, so that the
+        entities they have in common are only looked up once, and all
+        uncached entities are looked up together."""
+        alerts = [a for a in alerts if not a.violations_annotated]
+        expressions = set()
+        for alert in alerts:
+            expressions.update(alert._entity_expressions())
+
+        metas = {}
+        misses = []
+        for exp in expressions:
+            expkey = exp[0] + "/" + exp[1]
+            meta = cls.entity_cache.get(expkey)
+            if meta is MISSING:
+                misses.append(exp)
+            elif meta is not None:
+                metas[expkey] = meta
+
+        if misses:
+            # the client fills the cache, failed lookups are simply left out
+            for expkey, meta in cls.entity_client.lookup(misses).items():
+                if meta is not None:
+                    metas[expkey] = meta
+
+        # now assign meta to each violation
+        for alert in alerts:
+            for v in alert.violations:
+                if v.expression in metas:
+                    v.meta = metas[v.expression]
+            alert.violations_annotated = True
+
+    def _entity_expressions(self):
         # collect all the expressions from violations that don't already have
         # a meta set
         expressions = set()
@@ -99,58 +202,7 @@ class Alert:
                         enttype = "geoasn"
                         v.expression = enttype + "/" + entcode
                     expressions.add((enttype, entcode))
-
-        if not len(expressions):
-            # nothing to do...
-            self.violations_annotated = True
-            return
-
-        metas = {}
-        for exp in expressions:
-            expkey = exp[0] + "/" + exp[1]
-            resp = requests.get(self.IODA_ENTITY_API + "/query?entityType=" + exp[0] + "&entityCode=" + exp[1])
-            try:
-                res = resp.json()
-            except Exception as e:
-                logging.error('IODA entity annotation %s failed with JSON decode error: %s' % (exp, e.msg))
-                continue
-
-            if not res or 'data' not in res or not res['data'] or \
-                    len(res['data']) == 0:
-                logging.error('IODA entity annotation %s failed with error: %s' %
-                               (exp, res['error'] if res else None))
-                continue
-
-            try:
-                metas[expkey] = {
-                    "meta_type": res["data"][0]["type"],
-                    "fqid": res["data"][0]["attrs"]["fqid"],
-                    "meta_code": res["data"][0]["code"]
-                }
-            except Exception as e:
-                logging.error('Unable to parse IODA entity annotation %s: %s' % (exp, e))
-
-        # now assign meta to each violation
-        for v in self.violations:
-            if v.expression in metas:
-                v.meta = metas[v.expression]
-        self.violations_annotated = True
-
-    @property
-    def fqid(self):
-        return self._fqid
-
-    @fqid.setter
-    def fqid(self, v):
-        self._fqid = v
-
-    @property
-    def name(self):
-        return self._name
-
-    @name.setter
-    def name(self, v):
-        self._name = v
+        return expressions
 
     @property
     def level(self):
@@ -172,30 +224,6 @@ class Alert:
             raise TypeError('Alert time must be an integer (UTC epoch time)')
         self._time = v
 
-    @property
-    def expression(self):
-        return self._expression
-
-    @expression.setter
-    def expression(self, v):
-        self._expression = v
-
-    @property
-    def history_expression(self):
-        return self._history_expression
-
-    @history_expression.setter
-    def history_expression(self, v):
-        self._history_expression = v
-
-    @property
-    def method(self):
-        return self._method
-
-    @method.setter
-    def method(self, v):
-        self._method = v
-
     @property
     def violations(self):
         return self._violations
@@ -209,6 +237,9 @@ class Alert:
 
 class Violation:
 
+    __slots__ = ('expression', 'condition', 'value', 'history_value',
+                 '_history', 'time', 'meta')
+
     def __init__(self, expression, condition, value, history_value, history, time,
                  meta=None):
         self.expression = expression
@@ -219,6 +250,36 @@ class Violation:
         self.time = time
         self.meta = meta
 
+    @classmethod
+    def from_dict(cls, viol):
+        """Fast constructor from a decoded violation dict"""
+        history = viol['history']
+        if history is not None and not isinstance(history, list):
+            raise TypeError('Violation history must be a list')
+        self = cls.__new__(cls)
+        self.expression = viol['expression']
+        self.condition = viol['condition']
+        self.value = viol['value']
+        self.history_value = viol['history_value']
+        self._history = history
+        self.time = viol['time']
+        self.meta = viol.get('meta')
+        return self
+
+    @classmethod
+    def from_trusted(cls, expression, condition, value, history_value,
+                     history, time, meta=None):
+        """Fast constructor for fields that have already been validated"""
+        self = cls.__new__(cls)
+        self.expression = expression
+        self.condition = condition
+        self.value = value
+        self.history_value = history_value
+        self._history = history
+        self.time = time
+        self.meta = meta
+        return self
+
     def __repr__(self):
         return json.dumps(self.as_dict())
 
@@ -233,46 +294,6 @@ class Violation:
             'meta': self.meta,
         }
 
-    @property
-    def expression(self):
-        return self._expression
-
-    @expression.setter
-    def expression(self, v):
-        self._expression = v
-
-    @property
-    def condition(self):
-        return self._condition
-
-    @condition.setter
-    def condition(self, v):
-        self._condition = v
-
-    @property
-    def value(self):
-        return self._value
-
-    @value.setter
-    def value(self, v):
-        self._value = v
-
-    @property
-    def time(self):
-        return self._time
-
-    @time.setter
-    def time(self, v):
-        self._time = v
-
-    @property
-    def history_value(self):
-        return self._history_value
-
-    @history_value.setter
-    def history_value(self, v):
-        self._history_value = v
-
     @property
     def history(self):
         return self._history
@@ -282,11 +303,3 @@ class Violation:
         if v is not None and not isinstance(v, list):
             raise TypeError('Violation history must be a list')
         self._history = v
-
-    @property
-    def meta(self):
-        return self._meta
-
-    @meta.setter
-    def meta(self, meta):
-        self._meta = meta
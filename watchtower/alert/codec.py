@@ -0,0 +1,102 @@
+import json
+import logging
+from typing import Any, List, Optional
+
+# optional, faster JSON decoding backends
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class StdlibDecoder:
+    """Decodes alerts into plain dicts using the json module"""
+
+    name = 'json'
+    # whether decode returns typed structs rather than dicts
+    typed = False
+
+    def decode(self, data):
+        # json.loads accepts bytes directly
+        return json.loads(data)
+
+
+class OrjsonDecoder:
+    """Decodes alerts into plain dicts using orjson"""
+
+    name = 'orjson'
+    typed = False
+
+    def __init__(self):
+        self.decode = orjson.loads
+
+
+if msgspec is not None:
+    class ViolationStruct(msgspec.Struct):
+        expression: str
+        condition: Any
+        value: Any
+        history_value: Any
+        history: Optional[list]
+        time: Any
+        meta: Optional[dict] = None
+
+    class AlertStruct(msgspec.Struct):
+        fqid: str
+        name: str
+        level: str
+        time: int
+        expression: Any
+        history_expression: Any
+        method: Any
+        violations: List[ViolationStruct]
+
+
+class MsgspecDecoder:
+    """Decodes alerts straight into typed structs using msgspec, which also
+    validates the schema as it goes"""
+
+    name = 'msgspec'
+    typed = True
+
+    def __init__(self):
+        self._decoder = msgspec.json.Decoder(AlertStruct)
+
+    def decode(self, data):
+        try:
+            return self._decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e))
+
+
+DECODERS = {
+    'msgspec': (MsgspecDecoder, msgspec),
+    'orjson': (OrjsonDecoder, orjson),
+    'json': (StdlibDecoder, json),
+}
+
+# order in which backends are tried by 'auto'
+AUTO_ORDER = ['msgspec', 'orjson', 'json']
+
+
+def get_decoder(name='auto'):
+    """Get an alert decoder by name, or the fastest available one if name is
+    'auto'. Decoders accept either str or bytes."""
+    if name == 'auto':
+        for candidate in AUTO_ORDER:
+            if DECODERS[candidate][1] is not None:
+                return get_decoder(candidate)
+    if name not in DECODERS:
+        raise ValueError("Unknown JSON decoder '%s' (must be one of %s)"
+                         % (name, ['auto'] + list(DECODERS)))
+    clz, module = DECODERS[name]
+    if module is None:
+        logging.warning("JSON decoder '%s' is not installed, falling back "
+                        "to json" % name)
+        return StdlibDecoder()
+    return clz()
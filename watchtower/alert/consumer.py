@@ -1,12 +1,23 @@
 import argparse
+import asyncio
 import json
 import logging
 import os
 import confluent_kafka
+import signal
 import time
 
+from . import aio
+from . import metrics
+from . import replay
 from .alert import Alert
-from .consumers import *
+from .dedup import Deduplicator
+from .routing import Router
+from .consumers import get_consumer_class
+from .offsets import OffsetTracker
+from .supervisor import Supervisor
+from .timers import TimerScheduler
+from .workers import PluginWorker
 
 # list of kafka "errors" that are not really errors
 KAFKA_IGNORED_ERRS = [
@@ -14,6 +25,15 @@ KAFKA_IGNORED_ERRS = [
     confluent_kafka.KafkaError._TIMED_OUT,
 ]
 
+# name of our own timer, for logging stats
+STATS_TIMER = '(stats)'
+
+
+def configure_logging(level):
+    logging.basicConfig(level=level,
+                        format='%(asctime)s|WATCHTOWER|%(levelname)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
 
 class Consumer:
 
@@ -27,26 +47,126 @@ class Consumer:
         "brokers": "localhost:9092",
         "topic": "watchtower",
 
+        # timers fire at multiples of timer_interval seconds, or of the
+        # plugin's interval in timer_intervals. after a stall, up to
+        # timer_max_catchup missed timers are fired for each plugin.
         "timer_interval": 60,
+        "timer_intervals": {},
+        "timer_max_catchup": 10,
+
+        # "at-most-once" lets kafka auto-commit offsets as messages are
+        # consumed. "at-least-once" only commits the offset of a message
+        # once every alert plugin has handled it, in batches (see
+        # watchtower.alert.offsets.OffsetTracker for offset_commit options).
+        # plugins that buffer writes (e.g. database buffer_rows, or
+        # timeseries until its KPs are flushed) only ack alerts once they
+        # have written them. if a plugin fails to handle a message, it is not
+        # committed and the consumer stops, so that the message is
+        # redelivered when it restarts (unless offset_commit.ack_failed is
+        # set, in which case it is committed anyway, and lost).
+        "delivery": "at-most-once",
+        "offset_commit": {},
+
+        # "inline" runs each plugin in turn on the main thread, "threaded"
+        # runs each plugin on its own worker thread, fed by a bounded queue
+        # (see watchtower.alert.workers.PluginWorker for queue options, which
+        # can be overridden per plugin in plugin_queue_overrides).
+        # "asyncio" runs the plugins on an event loop, handling up to
+        # max_in_flight messages (or batches) concurrently, and is required
+        # for AsyncAbstractConsumer plugins (see watchtower.alert.aio)
+        "execution": "inline",
+        "plugin_queue": {},
+        "plugin_queue_overrides": {},
+        "max_in_flight": 100,
+
+        # number of messages to read from kafka at once, and the maximum time
+        # (in seconds) to wait for a batch to fill. a batch_size of 1 handles
+        # messages one at a time as they arrive.
+        "batch_size": 1,
+        "batch_linger": 1.0,
+
+        # one of auto, msgspec, orjson or json
+        "json_decoder": "auto",
+
+        # per-plugin metrics, served in prometheus format on port (plus the
+        # worker number, when running several workers) and summarized in the
+        # log on every timer
+        "metrics": {
+            "enabled": True,
+            "port": None,
+            "host": "",
+            "summary": False,
+        },
+
+        # drop alerts that have already been seen (see
+        # watchtower.alert.dedup.Deduplicator for options)
+        "dedup": {},
+
+        # alert plugin name => the alerts and violations it should handle
+        # (see watchtower.alert.routing.Route for options). plugins without
+        # a route use their default one (e.g. slack skips per-AS
+        # violations), if any, and otherwise handle every alert. an empty
+        # route ({}) disables a plugin's default route
+        "routes": {},
+
+        # see watchtower.alert.entities.EntityCache for options
+        "entity_cache": {},
+        # see watchtower.alert.entities.EntityClient for options
+        "entity_api": {},
 
         "consumers": {}
     }
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, replay=None, worker_id=None):
         self.config_file = os.path.expanduser(config_file)
         self.config = dict(self.defaults)
         self._load_config()
         self.topic = self.config['topic']
+        self.worker_id = worker_id
+        self.metrics = dict(self.defaults['metrics'])
+        self.metrics.update(self.config['metrics'])
+        if replay and self.config['execution'] == 'asyncio':
+            raise ValueError("Replay does not support the asyncio execution "
+                             "mode")
+
+        self.timers = None
+        self.running = False
 
-        self.next_timer = None
+        Alert.configure_decoder(self.config['json_decoder'])
+        self.dedup = Deduplicator.from_config(self.config['dedup'])
+        Alert.configure_entity_cache(self.config['entity_cache'])
+        Alert.configure_entity_client(self.config['entity_api'])
 
         self.consumer_instances = None
         self._init_plugins()
+        self.router = None
+        self._init_router()
 
         self.consumers = None
+        self.workers = None
         self._init_consumers()
 
-        # connect to kafka
+        # with several workers, plugins that keep state per alert name only
+        # see every alert of a name if the producer keys messages by name
+        self.name_order_plugins = [
+            name for name in self.config['alert_consumers']
+            if self.consumer_instances[name].needs_name_order()] \
+            if worker_id is not None else []
+        self.unkeyed_msgs = 0
+
+        self._init_timers()
+
+        if self.metrics['enabled']:
+            self._init_metrics()
+
+        # alert archives to replay instead of consuming from kafka
+        self.replay = replay
+        self.kc = None
+        self.offsets = None
+        if not self.replay:
+            self._init_kafka()
+
+    def _init_kafka(self):
         kafka_conf = {
             'bootstrap.servers': self.config['brokers'],
             'group.id': self.config['consumer_group'],
@@ -54,22 +174,116 @@ class Consumer:
             'heartbeat.interval.ms': 30000,
             'api.version.request': True,
         }
+        if self.metrics['enabled']:
+            # librdkafka reports consumer lag in its statistics
+            kafka_conf['statistics.interval.ms'] = 15000
+            kafka_conf['stats_cb'] = self._on_kafka_stats
+        if self.config['delivery'] == 'at-least-once':
+            kafka_conf['enable.auto.commit'] = False
+        elif self.config['delivery'] != 'at-most-once':
+            raise ValueError("Unknown delivery mode '%s'"
+                             % self.config['delivery'])
         self.kc = confluent_kafka.Consumer(**kafka_conf)
         logging.info("Subscribing to alerts from '%s'" % self.topic)
-        self.kc.subscribe([self.topic])
+        if self.config['delivery'] == 'at-least-once':
+            self.offsets = OffsetTracker.from_config(
+                self.kc, self.config['offset_commit'])
+            self.kc.subscribe([self.topic], on_revoke=self._on_revoke)
+        else:
+            self.kc.subscribe([self.topic])
+
+    def _on_revoke(self, kc, partitions):
+        logging.info("Partitions revoked: %s"
+                     % ["%s:%d" % (tp.topic, tp.partition)
+                        for tp in partitions])
+        self.offsets.revoke(partitions)
+
+    def _init_metrics(self):
+        cache_lookups = metrics.REGISTRY.gauge(
+            'watchtower_alert_entity_cache_lookups',
+            'IODA entity cache lookups, by result', ['result'])
+        cache_hit_ratio = metrics.REGISTRY.gauge(
+            'watchtower_alert_entity_cache_hit_ratio',
+            'Fraction of IODA entity lookups answered by the cache')
+        cache_size = metrics.REGISTRY.gauge(
+            'watchtower_alert_entity_cache_size',
+            'Entities in the IODA entity cache')
+
+        def collect_cache():
+            stats = Alert.entity_cache.stats()
+            for result in ['hits', 'negative_hits', 'misses']:
+                cache_lookups.labels(result).set(stats[result])
+            cache_hit_ratio.set(stats['hit_rate'])
+            cache_size.set(stats['size'])
+        metrics.REGISTRY.add_collector(collect_cache)
+
+        if self.workers:
+            queue_depth = metrics.REGISTRY.gauge(
+                'watchtower_alert_plugin_queue_depth',
+                'Alerts queued for each plugin worker', ['plugin'])
+            queue_lag = metrics.REGISTRY.gauge(
+                'watchtower_alert_plugin_queue_lag_seconds',
+                'Time the oldest queued item has been waiting', ['plugin'])
+            queue_dropped = metrics.REGISTRY.gauge(
+                'watchtower_alert_plugin_queue_dropped',
+                'Alerts dropped by each plugin worker', ['plugin'])
+            workers = {w.name: w for w in self.workers['alert'] +
+                       self.workers['timer']}
+
+            def collect_workers():
+                for name, worker in workers.items():
+                    stats = worker.stats()
+                    queue_depth.labels(name).set(stats['depth'] +
+                                                 stats['spill_depth'])
+                    queue_lag.labels(name).set(stats['queue_lag'])
+                    queue_dropped.labels(name).set(stats['dropped'])
+            metrics.REGISTRY.add_collector(collect_workers)
+
+        if self.metrics['port'] is not None:
+            metrics.start_http_server(
+                self.metrics['port'] + (self.worker_id or 0),
+                self.metrics['host'])
+
+    def _on_kafka_stats(self, stats_json):
+        stats = json.loads(stats_json)
+        for topic, tstats in stats.get('topics', {}).items():
+            for partition, pstats in tstats.get('partitions', {}).items():
+                # skip the internal UA partition, and partitions that are not
+                # assigned to us
+                if partition == '-1' or pstats.get('consumer_lag', -1) < 0:
+                    continue
+                metrics.KAFKA_CONSUMER_LAG.labels(topic, partition)\
+                    .set(pstats['consumer_lag'])
 
     def _init_plugins(self):
-        consumers = {
-            "log": LogConsumer,
-            "database": DatabaseConsumer,
-            # "traceroute": watchtower.alert.consumers.TracerouteConsumer,
-            "timeseries": TimeseriesConsumer,
-            "slack": SlackConsumer,
-        }
+        # only load the plugins that are actually used
+        names = []
+        for name in self.config['alert_consumers'] + \
+                self.config['timer_consumers']:
+            if name not in names:
+                names.append(name)
         self.consumer_instances = {}
-        for consumer, clz in list(consumers.items()):
+        for consumer in names:
+            clz = get_consumer_class(consumer)
             cfg = self.config['consumers'].get(consumer, None)
             self.consumer_instances[consumer] = clz(cfg)
+            self.consumer_instances[consumer].worker_id = self.worker_id
+            if self.metrics['enabled']:
+                wrapper = metrics.AsyncInstrumentedPlugin \
+                    if aio.is_async(self.consumer_instances[consumer]) \
+                    else metrics.InstrumentedPlugin
+                self.consumer_instances[consumer] = wrapper(
+                    consumer, self.consumer_instances[consumer])
+
+    def _init_router(self):
+        routes = {}
+        for name in self.config['alert_consumers']:
+            route = self.config['routes'].get(
+                name, self.consumer_instances[name].default_route())
+            if route is not None:
+                routes[name] = route
+        self.router = Router.from_config(self.config['alert_consumers'],
+                                         routes)
 
     def _load_config(self):
         with open(self.config_file) as fconfig:
@@ -78,59 +292,367 @@ class Consumer:
         # logging.debug(self.config)
 
     def _configure_logging(self):
-        logging.basicConfig(level=self.config.get('logging', 'info'),
-                            format='%(asctime)s|WATCHTOWER|%(levelname)s: %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S')
+        configure_logging(self.config.get('logging', 'info'))
 
     def _init_consumers(self):
+        execution = self.config['execution']
+        if execution not in ('inline', 'threaded', 'asyncio'):
+            raise ValueError("Unknown execution mode '%s'" % execution)
+        for cons_name, cons_inst in self.consumer_instances.items():
+            if execution != 'asyncio' and aio.is_async(cons_inst):
+                raise ValueError("Plugin '%s' requires the asyncio execution "
+                                 "mode" % cons_name)
+        # plugins that buffer alerts only release their offsets once they
+        # have written them, which may take a timer
+        at_least_once = self.config['delivery'] == 'at-least-once'
+        for name in self.config['alert_consumers']:
+            cons_inst = self.consumer_instances[name]
+            if (cons_inst.needs_timer() or
+                    (at_least_once and cons_inst.buffers_alerts())) and \
+                    name not in self.config['timer_consumers']:
+                raise ValueError("Plugin '%s' only flushes on timers, so it "
+                                 "must also be in timer_consumers" % name)
         self.consumers = {}
         for alert_type in ['alert', 'timer']:
             cfg = self.config[alert_type + '_consumers']
-            self.consumers[alert_type] = []
-            for cons_name in cfg:
-                cons_inst = self.consumer_instances[cons_name]
+            self.consumers[alert_type] = [self.consumer_instances[cons_name]
+                                          for cons_name in cfg]
+        # start each plugin once, even if it is in both lists (the asyncio
+        # runtime starts them on its event loop)
+        if execution != 'asyncio':
+            for cons_inst in self.consumer_instances.values():
                 cons_inst.start()
-                self.consumers[alert_type].append(cons_inst)
+        if execution == 'threaded':
+            self._init_workers()
 
-    def _handle_alert(self, msg):
-        logging.info("Handling alert: '%s'" % msg.value())
+    def _init_timers(self):
+        self.timers = TimerScheduler(self.config['timer_max_catchup'])
+        self.timers.add(STATS_TIMER, self.config['timer_interval'])
+        for name in self.config['timer_consumers']:
+            self.timers.add(name, self.config['timer_intervals'].get(
+                name, self.config['timer_interval']))
+        for name in self.config['timer_intervals']:
+            if name not in self.config['timer_consumers']:
+                logging.warning("Ignoring timer interval for '%s', which is "
+                                "not in timer_consumers" % name)
+
+    def _init_workers(self):
+        # one worker per plugin, shared by alerts and timers so that the
+        # plugin itself is only ever called from one thread
+        workers = {}
+        self.workers = {}
+        for alert_type in ['alert', 'timer']:
+            self.workers[alert_type] = []
+            for cons_name in self.config[alert_type + '_consumers']:
+                if cons_name not in workers:
+                    cfg = dict(self.config['plugin_queue'])
+                    cfg.update(self.config['plugin_queue_overrides']
+                               .get(cons_name, {}))
+                    worker = PluginWorker.from_config(
+                        cons_name, self.consumer_instances[cons_name], cfg)
+                    logging.info("Starting worker for plugin '%s' "
+                                 "(queue size: %d, overflow: %s)"
+                                 % (cons_name, worker.size, worker.overflow))
+                    worker.start()
+                    workers[cons_name] = worker
+                self.workers[alert_type].append(workers[cons_name])
+
+    def _stop_workers(self):
+        if not self.workers:
+            return
+        stopped = set()
+        for worker in self.workers['alert'] + self.workers['timer']:
+            if worker.name not in stopped and worker.is_alive():
+                logging.info("Draining worker for plugin '%s'" % worker.name)
+                worker.stop()
+                stopped.add(worker.name)
+
+    def _log_worker_stats(self):
+        if not self.workers:
+            return
+        logged = set()
+        for worker in self.workers['alert'] + self.workers['timer']:
+            if worker.name not in logged:
+                logging.info("Plugin '%s' queue stats: %s"
+                             % (worker.name, worker.stats()))
+                logged.add(worker.name)
+
+    def _decode_alert(self, data):
+        """Returns None if the alert can't be decoded, or is a duplicate"""
+        logging.info("Handling alert: '%s'" % data)
         try:
-            alert = Alert.from_json(msg.value())
+            alert = Alert.from_json(data)
         except (TypeError, ValueError) as e:
-            logging.error("Could not extract Alert from json: %s" % msg.value())
+            logging.error("Could not extract Alert from json: %s" % data)
+            logging.exception(e)
+            return None
+        if self.dedup is not None and self.dedup.is_duplicate(alert):
+            logging.debug("Dropping duplicate alert: '%s' at %d"
+                          % (alert.fqid, alert.time))
+            metrics.DUPLICATE_ALERTS.inc()
+            return None
+        return alert
+
+    def _track(self, msgs):
+        if self.offsets is None:
+            return None
+        return self.offsets.track(msgs, len(self.consumers['alert']))
+
+    def _handle_alert(self, msg):
+        ack = self._track([msg])
+        alert = self._decode_alert(msg.value())
+        if alert is None:
+            if ack is not None:
+                ack.complete()
+            return
+        self._dispatch_alert(alert, ack)
+
+    def _handle_alerts(self, msgs):
+        ack = self._track(msgs)
+        alerts = [self._decode_alert(msg.value()) for msg in msgs]
+        alerts = [alert for alert in alerts if alert is not None]
+        if not alerts:
+            if ack is not None:
+                ack.complete()
+            return
+        self._dispatch_alerts(alerts, ack)
+
+    def _route(self, alerts):
+        """Returns the list of alerts each alert plugin should handle"""
+        if self.router is None:
+            return [alerts] * len(self.consumers['alert'])
+        return self.router.route_batch(alerts)
+
+    def _dispatch_alert(self, alert, ack=None):
+        routed = self.router.route(alert) if self.router is not None \
+            else [alert] * len(self.consumers['alert'])
+        if self.workers:
+            for worker, plugin_alert in zip(self.workers['alert'], routed):
+                if plugin_alert is not None:
+                    worker.submit_alert(plugin_alert, ack)
+                elif ack is not None:
+                    # routed away from this plugin
+                    ack.ack()
+            return
+        for consumer, plugin_alert in zip(self.consumers['alert'], routed):
+            if plugin_alert is not None:
+                self._call_inline(consumer, consumer.handle_alert,
+                                  plugin_alert, ack)
+            elif ack is not None:
+                ack.ack()
+
+    def _dispatch_alerts(self, alerts, ack=None):
+        routed = self._route(alerts)
+        if self.workers:
+            for worker, plugin_alerts in zip(self.workers['alert'], routed):
+                if plugin_alerts:
+                    worker.submit_alerts(plugin_alerts, ack)
+                elif ack is not None:
+                    # routed away from this plugin
+                    ack.ack()
+            return
+        for consumer, plugin_alerts in zip(self.consumers['alert'], routed):
+            if plugin_alerts:
+                self._call_inline(consumer, consumer.handle_alerts,
+                                  plugin_alerts, ack)
+            elif ack is not None:
+                ack.ack()
+
+    @staticmethod
+    def _call_inline(consumer, handler, payload, ack):
+        # without an ack (at-most-once delivery), plugin exceptions are not
+        # caught
+        if ack is None:
+            handler(payload)
+            return
+        try:
+            handler(payload)
+        except Exception as e:
+            logging.error("Plugin %s failed to handle alerts" % consumer)
             logging.exception(e)
+            ack.fail()
             return
-        for consumer in self.consumers['alert']:
-            consumer.handle_alert(alert)
+        ack.handled(consumer)
+
+    def _check_failed(self):
+        """Stop consuming if a message that a plugin failed to handle is
+        holding back offset commits"""
+        if self.offsets is not None and self.offsets.failed is not None:
+            raise RuntimeError("Stopping: a plugin failed to handle the alert "
+                               "at %s:%d@%d, which will be redelivered on "
+                               "restart" % self.offsets.failed)
+
+    def _log_stats(self):
+        logging.debug("IODA entity cache stats: %s"
+                      % Alert.entity_cache.stats())
+        logging.debug("IODA entity API stats: %s"
+                      % Alert.entity_client.stats())
+        logging.debug("Timer stats: %s" % self.timers.stats())
+        if self.unkeyed_msgs:
+            logging.error("Received %d alerts without a message key: plugins "
+                          "%s need the producer to key alerts by name when "
+                          "running several workers, or alerts of the same "
+                          "name are split across workers"
+                          % (self.unkeyed_msgs, self.name_order_plugins))
+            self.unkeyed_msgs = 0
+        if self.dedup is not None:
+            logging.debug("Dedup stats: %s" % self.dedup.stats())
+        if self.offsets is not None:
+            logging.debug("Offset commit stats: %s" % self.offsets.stats())
+        if self.metrics['enabled'] and self.metrics['summary']:
+            for line in metrics.summary():
+                logging.info("METRICS: %s" % line)
+            logging.info("METRICS: entity cache hit rate: %.3f"
+                         % Alert.entity_cache.stats()['hit_rate'])
+            if self.dedup is not None:
+                logging.info("METRICS: duplicate alert rate: %.3f"
+                             % self.dedup.stats()['hit_rate'])
+        self._log_worker_stats()
+
+    def _handle_plugin_timer(self, name, now):
+        idx = self.config['timer_consumers'].index(name)
+        if self.workers:
+            self.workers['timer'][idx].submit_timer(now)
+        else:
+            self.consumers['timer'][idx].handle_timer(now)
 
     def _handle_timer(self, now):
-        for consumer in self.consumers['timer']:
-            consumer.handle_timer(now)
+        # fire every timer at once (e.g. at the end of a replay)
+        self._log_stats()
+        for name in self.config['timer_consumers']:
+            self._handle_plugin_timer(name, now)
+
+    def _handle_due_timers(self, now):
+        for name, when in self.timers.due(now):
+            if name == STATS_TIMER:
+                self._log_stats()
+            else:
+                self._handle_plugin_timer(name, when)
+
+    def _stop_plugins(self):
+        # plugins may be in both the alert and timer lists
+        for consumer in set(self.consumers['alert'] + self.consumers['timer']):
+            try:
+                consumer.stop()
+            except Exception as e:
+                logging.error("Failed to stop plugin %s" % consumer)
+                logging.exception(e)
+
+    def shutdown(self, *args):
+        logging.info("Shutting down")
+        self.running = False
 
     def run(self):
-        # loop forever consuming alerts
-        while True:
-            # TIMERS
-            now = time.time()
-            if not self.next_timer or now >= self.next_timer:
-                if self.next_timer:
-                    self._handle_timer(now)
-                    self.next_timer += self.config['timer_interval']
-                else:
-                    interval = self.config['timer_interval']
-                    self.next_timer = (int(now/interval) * interval) + interval
+        self.running = True
+        signal.signal(signal.SIGTERM, self.shutdown)
+        try:
+            if self.replay:
+                self._run_replay()
+            elif self.config['execution'] == 'asyncio':
+                # stops the plugins itself
+                asyncio.run(aio.AsyncRuntime(
+                    self, self.config['max_in_flight']).run())
+            else:
+                self._run()
+        finally:
+            self._stop_workers()
+            if self.config['execution'] != 'asyncio':
+                self._stop_plugins()
+            if self.offsets is not None:
+                self.offsets.maybe_commit(force=True, asynchronous=False)
+            # persist the entities looked up since the last write
+            Alert.entity_cache.flush()
+            if self.kc is not None:
+                self.kc.close()
 
-            # ALERTS
-            msg = self.kc.poll(10)
-            if msg is None:
-                continue
+    def _poll(self):
+        # wait for alerts only until the next timer is due
+        poll_start = time.perf_counter()
+        if self.config['batch_size'] > 1:
+            msgs = self.kc.consume(
+                self.config['batch_size'],
+                self.timers.timeout(time.time(), self.config['batch_linger']))
+        else:
+            msg = self.kc.poll(self.timers.timeout(time.time(), 10))
+            msgs = [msg] if msg is not None else []
+        metrics.KAFKA_POLL_SECONDS.observe(time.perf_counter() - poll_start)
+        return msgs
+
+    def _check_msgs(self, msgs):
+        """Returns the messages that are alerts, and whether we hit a fatal
+        error"""
+        good_msgs = []
+        fatal = False
+        for msg in msgs:
             if not msg.error():
-                self._handle_alert(msg)
+                if self.name_order_plugins and msg.key() is None:
+                    self.unkeyed_msgs += 1
+                good_msgs.append(msg)
             elif msg.error().code() in KAFKA_IGNORED_ERRS:
                 logging.debug("Ignoring benign kafka 'error': %s" % msg.error().code())
             else:
                 logging.error("Unhandled Kafka error: %s" % msg.error())
+                fatal = True
                 break
+        metrics.KAFKA_MESSAGES.inc(len(good_msgs))
+        return good_msgs, fatal
+
+    def _run(self):
+        # loop until asked to stop consuming alerts
+        while self.running:
+            # TIMERS
+            self._handle_due_timers(time.time())
+
+            # ALERTS
+            good_msgs, fatal = self._check_msgs(self._poll())
+            if len(good_msgs) == 1:
+                self._handle_alert(good_msgs[0])
+            elif good_msgs:
+                self._handle_alerts(good_msgs)
+            if self.offsets is not None:
+                self.offsets.maybe_commit()
+                self._check_failed()
+            if fatal:
+                break
+
+    def _run_replay(self):
+        # replay archived alerts as fast as the plugins allow, with timers
+        # driven by alert time rather than wall-clock time
+        start = time.time()
+        alert_cnt = 0
+        viol_cnt = 0
+        batch = []
+        for data in replay.iter_records(self.replay):
+            if not self.running:
+                break
+            alert = self._decode_alert(data)
+            if alert is None:
+                continue
+            alert_cnt += 1
+            viol_cnt += len(alert.violations)
+            # timers must fire before any alert from a later interval
+            next_due = self.timers.next_due()
+            if batch and next_due is not None and alert.time >= next_due:
+                self._dispatch_alerts(batch)
+                batch = []
+            self._handle_due_timers(alert.time)
+            batch.append(alert)
+            if len(batch) >= self.config['batch_size']:
+                self._dispatch_alerts(batch)
+                batch = []
+        if batch:
+            self._dispatch_alerts(batch)
+        # flush whatever the plugins are holding for the last interval
+        if self.timers.next_due() is not None:
+            self._handle_timer(self.timers.next_due())
+        self._stop_workers()
+
+        elapsed = time.time() - start
+        logging.info("Replayed %d alerts (%d violations) in %.2fs "
+                     "(%.1f alerts/s, %.1f violations/s)"
+                     % (alert_cnt, viol_cnt, elapsed,
+                        alert_cnt / elapsed if elapsed else 0,
+                        viol_cnt / elapsed if elapsed else 0))
 
 
 def main():
@@ -141,8 +663,22 @@ def main():
     parser.add_argument('-c',  '--config-file',
                         nargs='?', required=True,
                         help='Config file')
+    parser.add_argument('-r', '--replay',
+                        nargs='+', metavar='FILE',
+                        help='Replay alerts from JSONL archives (plain, .gz '
+                             'or .zst) instead of consuming from Kafka')
+    parser.add_argument('-w', '--workers',
+                        type=int, default=1,
+                        help='Number of worker processes to run in the same '
+                             'consumer group (default: 1)')
 
     opts = vars(parser.parse_args())
+    workers = opts.pop('workers')
 
-    server = Consumer(**opts)
+    if workers > 1:
+        if opts['replay']:
+            parser.error("--workers cannot be used with --replay")
+        server = Supervisor(opts['config_file'], workers)
+    else:
+        server = Consumer(**opts)
     server.run()
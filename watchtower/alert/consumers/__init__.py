@@ -1,17 +1,79 @@
 import abc
+import importlib
+import importlib.metadata
+import threading
 
 
-class AbstractConsumer(metaclass=abc.ABCMeta):
+class _AckHolder:
+    """Holds the offset acks (see watchtower.alert.offsets) of alerts that a
+    consumer has handled but not yet written, see buffers_alerts"""
+
+    def _init_held_acks(self):
+        self._held_acks = []
+        self._held_acks_lock = threading.Lock()
+
+    def buffers_alerts(self):
+        # consumers that only write alerts some time after handling them
+        # (e.g. from handle_timer) should return True, and call
+        # release_acks() whenever everything they have handled so far has
+        # been written. with at-least-once delivery, the offsets of the
+        # alerts are not committed until then.
+        return False
+
+    def hold_ack(self, ack):
+        with self._held_acks_lock:
+            self._held_acks.append(ack)
+
+    def release_acks(self):
+        with self._held_acks_lock:
+            acks = self._held_acks
+            self._held_acks = []
+        for ack in acks:
+            ack.ack()
+
+
+class AbstractConsumer(_AckHolder, metaclass=abc.ABCMeta):
+    # set by the consumer when running as one of several --workers, so that
+    # state kept on disk (e.g. checkpoints) can be kept per worker
+    worker_id = None
+
     def __init__(self, config):
         self.config = config
+        self._init_held_acks()
 
     def start(self):
         pass
 
+    def stop(self):
+        # called once when the consumer shuts down, flush any buffered state
+        pass
+
+    def needs_timer(self):
+        # consumers that only flush buffered state on timers should return
+        # True, so that the consumer refuses to run them without one
+        return False
+
+    def needs_name_order(self):
+        # consumers that keep state per alert name, and so need every alert
+        # of a name to reach the same worker, in order, should return True
+        # (see watchtower.alert.supervisor.Supervisor)
+        return False
+
+    def default_route(self):
+        # the alerts and violations to hand to this consumer unless the
+        # consumer config routes them itself (see watchtower.alert.routing),
+        # or None for all of them
+        return None
+
     @abc.abstractmethod
     def handle_alert(self, alert):
         pass
 
+    def handle_alerts(self, alerts):
+        # consumers that can amortize work across alerts should override this
+        for alert in alerts:
+            self.handle_alert(alert)
+
     @abc.abstractmethod
     def handle_error(self, error):
         pass
@@ -20,12 +82,109 @@ class AbstractConsumer(metaclass=abc.ABCMeta):
     def handle_timer(self, now):
         pass
 
-# When adding a consumer here, also add to _init_plugins method in
-# watchtower.alert.consumer.py
-# TODO: make adding consumer more dynamic
-from .log import LogConsumer
-# from watchtower.alert.consumers.email import EmailConsumer
-from .database import DatabaseConsumer
-# from watchtower.alert.consumers.traceroute import TracerouteConsumer
-from .timeseries import TimeseriesConsumer
-from .slack import SlackConsumer
\ No newline at end of file
+
+class AsyncAbstractConsumer(_AckHolder, metaclass=abc.ABCMeta):
+    """Base for consumers whose handlers are coroutines, for the asyncio
+    execution mode (see watchtower.alert.aio).
+
+    Up to max_in_flight alerts are handled at once, so handle_alert may be
+    called again before an earlier call has finished. Consumers that need
+    alerts in order must serialize them themselves (e.g. with an
+    asyncio.Lock).
+    """
+
+    # see AbstractConsumer.worker_id
+    worker_id = None
+
+    def __init__(self, config):
+        self.config = config
+        self._init_held_acks()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        # called once when the consumer shuts down, flush any buffered state
+        pass
+
+    def needs_timer(self):
+        # see AbstractConsumer.needs_timer
+        return False
+
+    def needs_name_order(self):
+        # see AbstractConsumer.needs_name_order
+        return False
+
+    def default_route(self):
+        # see AbstractConsumer.default_route
+        return None
+
+    @abc.abstractmethod
+    async def handle_alert(self, alert):
+        pass
+
+    async def handle_alerts(self, alerts):
+        for alert in alerts:
+            await self.handle_alert(alert)
+
+    @abc.abstractmethod
+    async def handle_error(self, error):
+        pass
+
+    @abc.abstractmethod
+    async def handle_timer(self, now):
+        pass
+
+# Consumers are looked up by the name used in the alert_consumers and
+# timer_consumers config options, and only imported when configured, so that
+# e.g. a log-only deployment never imports sqlalchemy or _pytimeseries.
+# Other packages can provide consumers by registering a subclass of
+# AbstractConsumer under the ENTRY_POINT_GROUP entry point group, e.g.:
+#   entry_points={'watchtower.alert.consumers': [
+#       'mything=mypackage.consumer:MyThingConsumer']}
+ENTRY_POINT_GROUP = 'watchtower.alert.consumers'
+
+# name => (module, class) of the consumers in this package
+BUILTIN_CONSUMERS = {
+    'log': ('.log', 'LogConsumer'),
+    # 'email': ('.email', 'EmailConsumer'),
+    'database': ('.database', 'DatabaseConsumer'),
+    # 'traceroute': ('.traceroute', 'TracerouteConsumer'),
+    'timeseries': ('.timeseries', 'TimeseriesConsumer'),
+    'slack': ('.slack', 'SlackConsumer'),
+}
+
+
+def _entry_points():
+    eps = importlib.metadata.entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=ENTRY_POINT_GROUP)
+    # python < 3.10
+    return eps.get(ENTRY_POINT_GROUP, [])
+
+
+def available_consumers():
+    """Names of all built-in and registered consumers"""
+    return sorted(set(BUILTIN_CONSUMERS) |
+                  set(ep.name for ep in _entry_points()))
+
+
+def get_consumer_class(name):
+    """Import and return the consumer class registered under name"""
+    if name in BUILTIN_CONSUMERS:
+        module, clz = BUILTIN_CONSUMERS[name]
+        return getattr(importlib.import_module(module, __name__), clz)
+    for ep in _entry_points():
+        if ep.name == name:
+            return ep.load()
+    raise ValueError("Unknown consumer '%s' (must be one of %s)"
+                     % (name, available_consumers()))
+
+
+def __getattr__(name):
+    # keep "from watchtower.alert.consumers import LogConsumer" etc. working
+    # without importing every consumer up front
+    for module, clz in BUILTIN_CONSUMERS.values():
+        if clz == name:
+            return getattr(importlib.import_module(module, __name__), clz)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
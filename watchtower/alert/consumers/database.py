@@ -1,8 +1,11 @@
 import logging
 import sqlalchemy
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.dialects.sqlite
 import sqlalchemy.engine.url
 
 from . import AbstractConsumer
+from ..alert import Alert
 
 
 class DatabaseConsumer(AbstractConsumer):
@@ -18,16 +21,33 @@ class DatabaseConsumer(AbstractConsumer):
         'table_prefix': 'watchtower',
         'alert_table_name': 'alert',
         'error_table_name': 'error',
+        # buffer violation rows from many alerts and insert them in one
+        # transaction once there are at least this many, or on each timer
+        # (so database must then be a timer consumer). 0 inserts each alert
+        # as it arrives.
+        'buffer_rows': 0,
     }
 
     def __init__(self, config):
         super(DatabaseConsumer, self).__init__(self.defaults)
         if config:
             self.config.update(config)
+        # list of violation row lists, one per alert
+        self.buffer = []
+        self.buffered_rows = 0
 
     def start(self):
         self._init_db()
 
+    def stop(self):
+        self._flush()
+
+    def needs_timer(self):
+        return bool(self.config['buffer_rows'])
+
+    def buffers_alerts(self):
+        return bool(self.config['buffer_rows'])
+
     def _init_db(self):
         meta = sqlalchemy.MetaData()
 
@@ -102,51 +122,145 @@ class DatabaseConsumer(AbstractConsumer):
         # Its a little unsafe to log this since it may have a password:
         # logging.debug('Database engine url: %s', str(self.url))
 
-        self.engine = sqlalchemy.create_engine(self.url,
-                                               **self.config['engine_params'])
+        engine_params = dict(self.config['engine_params'])
+        if self.url.get_driver_name() == 'psycopg2':
+            # have psycopg2 send multi-row VALUES lists for executemany (an
+            # option that other postgresql drivers reject)
+            engine_params.setdefault('executemany_mode', 'values_plus_batch')
+        self.engine = sqlalchemy.create_engine(self.url, **engine_params)
         meta.create_all(self.engine)
 
+        self.alert_upsert = self._upsert(
+            self.t_alert, ['fqid', 'time', 'level', 'expression'])
+        self.error_upsert = self._upsert(
+            self.t_error, ['fqid', 'query_time', 'type', 'message'])
+
+    def _upsert(self, table, unique_cols):
+        """Build an INSERT that silently skips rows that already exist, if the
+        database dialect supports ON CONFLICT DO NOTHING"""
+        dialects = {
+            'postgresql': sqlalchemy.dialects.postgresql,
+            'sqlite': sqlalchemy.dialects.sqlite,
+        }
+        dialect = dialects.get(self.engine.dialect.name)
+        if dialect is None:
+            logging.warning("Database dialect '%s' does not support upserts, "
+                            "duplicate inserts will fail"
+                            % self.engine.dialect.name)
+            return None
+        return dialect.insert(table)\
+            .on_conflict_do_nothing(index_elements=unique_cols)
+
     def _table_name(self, table):
         suffix = self.config['%s_table_name' % table]
         return "%s_%s" % (self.config['table_prefix'], suffix) \
             if self.config['table_prefix'] else suffix
 
+    def _alert_rows(self, alert):
+        adict = alert.as_dict()
+        vdicts = adict.pop('violations')
+        for vdict in vdicts:
+            mdict = vdict.pop('meta')
+            if mdict is None:
+                mdict = {
+                    'meta_type': None,
+                    'meta_code': None,
+                }
+            vdict.update({
+                'fqid': adict['fqid'],
+                'name': adict['name'],
+                'level': adict['level'],
+                'query_time': adict['time'],
+                'query_expression': adict['expression'],
+                'history_query_expression': adict['history_expression'],
+                'method': adict['method'],
+                'meta_type': mdict['meta_type'],
+                'meta_code': mdict['meta_code'] if "meta_code" in mdict else None
+            })
+            # get rid of the history column
+            vdict.pop("history")
+        return vdicts
+
+    def _insert_rows(self, conn, vdicts):
+        if not vdicts:
+            return
+        if self.alert_upsert is not None:
+            with conn.begin():
+                conn.execute(self.alert_upsert, vdicts)
+            return
+        # no upserts, so the whole alert fails if any row already exists
+        try:
+            with conn.begin():
+                ins = self.t_alert.insert().values(vdicts)
+                res = conn.execute(ins)
+        except sqlalchemy.exc.IntegrityError as e:
+            logging.warn("Alert insert failed (maybe it already exists?)")
+            logging.debug(e)
+
     def handle_alert(self, alert):
         logging.debug("DB consumer handling alert")
         # we need violation annotations, so ensure that has been done
         alert.annotate_violations()
+        if self.config['buffer_rows']:
+            self._buffer(self._alert_rows(alert))
+            return
         with self.engine.connect() as conn:
-            adict = alert.as_dict()
-            vdicts = adict.pop('violations')
-            for vdict in vdicts:
-                mdict = vdict.pop('meta')
-                if mdict is None:
-                    mdict = {
-                        'meta_type': None,
-                        'meta_code': None,
-                    }
-                vdict.update({
-                    'fqid': adict['fqid'],
-                    'name': adict['name'],
-                    'level': adict['level'],
-                    'query_time': adict['time'],
-                    'query_expression': adict['expression'],
-                    'history_query_expression': adict['history_expression'],
-                    'method': adict['method'],
-                    'meta_type': mdict['meta_type'],
-                    'meta_code': mdict['meta_code'] if "meta_code" in mdict else None
-                })
-                # get rid of the history column
-                vdict.pop("history")
-
-            # dirty hax below. should do a select first
+            self._insert_rows(conn, self._alert_rows(alert))
+
+    def handle_alerts(self, alerts):
+        logging.debug("DB consumer handling %d alerts" % len(alerts))
+        Alert.annotate_alerts(alerts)
+        rows = [self._alert_rows(alert) for alert in alerts]
+        if self.config['buffer_rows']:
+            for vdicts in rows:
+                self._buffer(vdicts)
+            return
+        self._insert_batch(rows)
+
+    def _buffer(self, vdicts):
+        if not vdicts:
+            return
+        self.buffer.append(vdicts)
+        self.buffered_rows += len(vdicts)
+        if self.buffered_rows >= self.config['buffer_rows']:
+            self._flush()
+
+    def _flush(self):
+        if not self.buffer:
+            # alerts without rows may still be waiting for their acks
+            self.release_acks()
+            return
+        logging.debug("DB consumer flushing %d rows from %d alerts"
+                      % (self.buffered_rows, len(self.buffer)))
+        # keep the rows buffered until they are inserted, so that a failed
+        # insert is retried on the next flush
+        self._insert_batch(self.buffer)
+        self.buffer = []
+        self.buffered_rows = 0
+        self.release_acks()
+
+    def _insert_batch(self, rows):
+        """Insert the rows of several alerts (a list of row lists)"""
+        if not any(rows):
+            return
+        with self.engine.connect() as conn:
+            if self.alert_upsert is not None:
+                # duplicate rows are skipped individually
+                with conn.begin():
+                    conn.execute(self.alert_upsert,
+                                 [r for vdicts in rows for r in vdicts])
+                return
+            # try the whole batch in one transaction, falling back to one
+            # transaction per alert if any of them already exists
             try:
                 with conn.begin():
-                    ins = self.t_alert.insert().values(vdicts)
-                    res = conn.execute(ins)
+                    conn.execute(self.t_alert.insert(),
+                                 [r for vdicts in rows for r in vdicts])
+                return
             except sqlalchemy.exc.IntegrityError as e:
-                logging.warn("Alert insert failed (maybe it already exists?)")
                 logging.debug(e)
+            for vdicts in rows:
+                self._insert_rows(conn, vdicts)
 
     def handle_error(self, error):
         logging.debug("DB consumer handling error")
@@ -158,12 +272,16 @@ class DatabaseConsumer(AbstractConsumer):
                 'history_query_expression': edict.pop('history_expression')
             })
 
+            if self.error_upsert is not None:
+                with conn.begin():
+                    conn.execute(self.error_upsert, edict)
+                return
             try:
-                ins = self.t_error.insert().values(**edict)
-                conn.execute(ins)
+                with conn.begin():
+                    conn.execute(self.t_error.insert(), edict)
             except sqlalchemy.exc.IntegrityError as e:
                 logging.warn("Error insert failed (maybe it already exists?)")
                 logging.debug(e)
 
     def handle_timer(self, now):
-        pass
+        self._flush()
@@ -1,15 +1,66 @@
+import collections
 import logging
 import slack
 from slack.errors import SlackApiError
+import threading
 import time
 
 from . import AbstractConsumer
+from ..alert import Alert
+
+
+class TokenBucket:
+    """Allows rate events per second on average, in bursts of up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def delay(self):
+        """Take a token if one is available and return 0, otherwise return
+        how long to wait until one will be"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
 
 class SlackConsumer(AbstractConsumer):
+    """Posts outage start/end messages to a Slack channel.
+
+    Messages are queued and posted by a background sender thread, at most
+    rate_limit per second (in bursts of up to rate_burst), so that handling
+    an alert never waits on Slack. When the queue is full, new messages are
+    dropped. When Slack rate limits us anyway, the sender waits for as long
+    as its Retry-After header says.
+
+    In digest mode, violations are instead collected for digest_window
+    seconds and posted as a single message per alert name (see
+    _build_digest).
+    """
 
     defaults = {
         'api_token': None,
-        'channel': None
+        'channel': None,
+        # Slack allows about one message per second per channel
+        'rate_limit': 1.0,
+        'rate_burst': 3,
+        'queue_size': 1000,
+        'max_retries': 5,
+        # how long to keep posting queued messages on shutdown
+        'stop_timeout': 30,
+        # post one summary per alert name every digest_window seconds
+        # instead of one message per violation (digests are posted on
+        # timers, so slack must then be a timer consumer)
+        'digest': False,
+        'digest_window': 300,
+        # violations listed per meta type in a digest, by relative drop
+        'digest_top': 10,
     }
 
     def __init__(self, config):
@@ -19,9 +70,46 @@ class SlackConsumer(AbstractConsumer):
         self.channel = None
         self.client = None
 
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._stop_deadline = None
+        self._sender = None
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+        # alert name => [(rel_drop, violation time, details)]
+        self.digest = collections.OrderedDict()
+        self.digest_start = None
+
     def start(self):
         self.channel = self.config['channel']
         self.client = slack.WebClient(token=self.config['api_token'])
+        self._sender = threading.Thread(target=self._send_loop,
+                                        name='slack-sender', daemon=True)
+        self._sender.start()
+
+    def stop(self):
+        if self._sender is None:
+            return
+        self._flush_digest()
+        with self._cond:
+            self._stopping = True
+            self._stop_deadline = time.monotonic() + self.config['stop_timeout']
+            self._cond.notify()
+        self._sender.join(self.config['stop_timeout'] + 1)
+        if self._queue:
+            logging.error("Slack: dropping %d queued messages on shutdown"
+                          % len(self._queue))
+
+    def needs_timer(self):
+        return bool(self.config['digest'])
+
+    def default_route(self):
+        # per-AS alerts are too noisy, and are dropped before they are
+        # annotated
+        return {'exclude_meta_types': ['asn']}
 
     @staticmethod
     def _build_dashboard_url(meta_type, meta_code, from_time, until_time):
@@ -105,9 +193,101 @@ class SlackConsumer(AbstractConsumer):
                        actual, predicted, pct_drop,
                        alert_time)
 
+    def _build_digest(self, name, violations):
+        """Summary of the violations of an alert name: for each meta type,
+        the number of outage starts and ends, and the top violations by
+        relative drop"""
+        by_type = collections.OrderedDict()
+        for rel_drop, _, details in violations:
+            by_type.setdefault(details['meta_type'], []).append(
+                (rel_drop, details))
+        times = [t for _, t, _ in violations]
+        period = "%s - %s" % (
+            time.strftime('%m/%d/%Y %H:%M', time.gmtime(min(times))),
+            time.strftime('%m/%d/%Y %H:%M UTC', time.gmtime(max(times))))
+
+        blocks = [{
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "*%s*: %d violations (%s)"
+                        % (name, len(violations), period)
+            }
+        }]
+        text_lines = ["%s: %d violations (%s)"
+                      % (name, len(violations), period)]
+        top = self.config['digest_top']
+        for meta_type, viols in by_type.items():
+            # unknown drops sort last
+            viols.sort(key=lambda v: -v[0] if v[0] is not None
+                       else float('inf'))
+            starts = sum(1 for _, d in viols if d['position'] == "Outage Start")
+            summary = "%s: %d outage starts, %d outage ends" % (
+                (meta_type or "Unknown").title(), starts, len(viols) - starts)
+            lines = ["*%s*" % summary]
+            for _, d in viols[:top]:
+                lines.append("• <%s|%s> %s, drop: %s (%s/%s)" % (
+                    self._build_dashboard_url(d['meta_type'], d['meta_code'],
+                                              d['from_time'],
+                                              d['until_time']),
+                    d['meta_code'], d['position'], d['pct_drop'],
+                    d['actual'], d['predicted']))
+            if len(viols) > top:
+                lines.append("…and %d more" % (len(viols) - top))
+            blocks.append({
+                "type": "section",
+                "text": {"type": "mrkdwn", "text": "\n".join(lines)}
+            })
+            text_lines.append(summary)
+        blocks.append({"type": "divider"})
+        return blocks, "\n".join(text_lines)
+
+    def _flush_digest(self):
+        for name, violations in self.digest.items():
+            self._enqueue(*self._build_digest(name, violations))
+        self.digest.clear()
+
+    def _wait(self, delay):
+        """Sleep for delay seconds, or less if we run out of time to stop.
+        Returns False if we have run out of time."""
+        end = time.monotonic() + delay
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._stop_deadline is not None and \
+                        now >= self._stop_deadline:
+                    return False
+                if now >= end:
+                    return True
+                until = end if self._stop_deadline is None \
+                    else min(end, self._stop_deadline)
+                self._cond.wait(until - now)
+
+    def _send_loop(self):
+        bucket = TokenBucket(self.config['rate_limit'],
+                             self.config['rate_burst'])
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                msg_blocks, msg_text = self._queue[0]
+            delay = bucket.delay()
+            while delay:
+                if not self._wait(delay):
+                    return
+                delay = bucket.delay()
+            if not self._post(msg_blocks, msg_text):
+                return
+            with self._cond:
+                self._queue.popleft()
+
     def _post(self, msg_blocks, msg_text):
-        retries = 5
-        while retries > 0:
+        """Post a message, retrying when rate limited. Returns False if we
+        ran out of time to stop while waiting to retry."""
+        retries = self.config['max_retries']
+        while True:
             try:
                 self.client.chat_postMessage(
                     channel=self.channel,
@@ -115,20 +295,35 @@ class SlackConsumer(AbstractConsumer):
                     text=msg_text,
                 )
             except SlackApiError as e:
-                if e.response['error'] == 'ratelimited':
-                    retries -= 1
-                    if retries == 0:
-                        raise e
-                    logging.warning("Hit slack rate limit. Waiting 30s.")
-                    time.sleep(30)
-                    continue
-                raise e
-            return
+                retries -= 1
+                if e.response['error'] != 'ratelimited' or retries <= 0:
+                    self.failed += 1
+                    logging.error("Failed to post Slack message: %s" % e)
+                    return True
+                retry_after = int(e.response.headers.get('Retry-After', 30))
+                logging.warning("Hit slack rate limit. Waiting %ds."
+                                % retry_after)
+                if not self._wait(retry_after):
+                    return False
+                continue
+            except Exception as e:
+                self.failed += 1
+                logging.error("Failed to post Slack message: %s" % e)
+                return True
+            self.sent += 1
+            return True
 
     def _send_msg(self, msg_details):
-        msg_blocks = self._build_msg_blocks(**msg_details)
-        msg_text = self._build_msg_text(**msg_details)
-        self._post(msg_blocks, msg_text)
+        self._enqueue(self._build_msg_blocks(**msg_details),
+                      self._build_msg_text(**msg_details))
+
+    def _enqueue(self, msg_blocks, msg_text):
+        with self._cond:
+            if len(self._queue) >= self.config['queue_size']:
+                self.dropped += 1
+                return
+            self._queue.append((msg_blocks, msg_text))
+            self._cond.notify()
 
     def handle_alert(self, alert):
         logging.info("Slack handling alert: '%s'" % alert.fqid)
@@ -136,9 +331,6 @@ class SlackConsumer(AbstractConsumer):
         for viol in alert.violations:
             if viol.meta is None:
                 continue
-            # per-AS alerts are too noisy
-            if 'meta_type' in viol.meta and viol.meta['meta_type'] == 'asn':
-                continue
 
             rel_drop = None
             if viol.history_value is not None and viol.value is not None:
@@ -157,10 +349,31 @@ class SlackConsumer(AbstractConsumer):
                 "pct_drop": pct_drop_str,
                 "alert_time": time.strftime('%m/%d/%Y %H:%M:%S UTC', time.gmtime(viol.time)),
             }
-            self._send_msg(details)
+            if self.config['digest']:
+                self.digest.setdefault(alert.name, []).append(
+                    (rel_drop, viol.time, details))
+            else:
+                self._send_msg(details)
+
+    def handle_alerts(self, alerts):
+        # look up the entities for the whole batch at once
+        Alert.annotate_alerts(alerts)
+        for alert in alerts:
+            self.handle_alert(alert)
 
     def handle_error(self, error):
         pass
 
     def handle_timer(self, now):
-        pass
\ No newline at end of file
+        if self.config['digest']:
+            if self.digest_start is None:
+                self.digest_start = now
+            elif now - self.digest_start >= self.config['digest_window']:
+                self._flush_digest()
+                self.digest_start = now
+        if self.dropped:
+            logging.warning("Slack: dropped %d messages (queue full)"
+                            % self.dropped)
+            self.dropped = 0
+        logging.debug("Slack: %d messages queued, %d sent, %d failed"
+                      % (len(self._queue), self.sent, self.failed))
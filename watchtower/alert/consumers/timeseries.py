@@ -1,7 +1,45 @@
+import collections
+import heapq
+import json
 import logging
+import os
+import tempfile
+import time
 import _pytimeseries
 
 from . import AbstractConsumer
+from ..alert import Alert
+from .. import metrics
+
+SERIES = metrics.REGISTRY.gauge(
+    'watchtower_alert_timeseries_series',
+    'Series tracked by the timeseries consumer', ['alert'])
+KP_KEYS = metrics.REGISTRY.gauge(
+    'watchtower_alert_timeseries_kp_keys',
+    'Keys in the key package of each alert name, including dead keys',
+    ['alert'])
+EVICTED_SERIES = metrics.REGISTRY.counter(
+    'watchtower_alert_timeseries_evicted_series_total',
+    'Series that the timeseries consumer stopped tracking', ['reason'])
+
+# name of the state of all alerts in the 'shared' flush mode
+ALL_ALERTS = '*'
+
+# format of the checkpoint file
+CHECKPOINT_VERSION = 1
+
+
+class Series:
+    """The KP indices of the level and delta keys of a series, and the values
+    last set for them"""
+
+    __slots__ = ('level_idx', 'delta_idx', 'level', 'delta')
+
+    def __init__(self, level_idx, delta_idx):
+        self.level_idx = level_idx
+        self.delta_idx = delta_idx
+        self.level = 0
+        self.delta = 0
 
 
 class TimeseriesConsumer(AbstractConsumer):
@@ -16,6 +54,26 @@ class TimeseriesConsumer(AbstractConsumer):
         'producer_repeat_interval': 7200,  # 2 hours
         'producer_max_interval': 600,
         'alert_reset_timeout': 7860,
+        # stop tracking series that have been at normal level for longer than
+        # this (seconds, None to keep them forever)
+        'series_retention': None,
+        # maximum number of series tracked across all alert names (None for
+        # no limit). Series at normal level are evicted to make room for new
+        # ones, oldest first, and new series are ignored if there are none.
+        'max_series': None,
+        # rebuild a KP once this many, and this fraction, of its keys belong
+        # to evicted series
+        'compact_min_dead_keys': 1000,
+        'compact_dead_ratio': 0.5,
+        # periodically snapshot the state to this file, and restore it on
+        # start (None to disable). each of several --workers uses its own
+        # file, with its worker number added before the extension
+        'checkpoint_path': None,
+        'checkpoint_interval': 300,
+        # 'per-alert': a KP per alert name, each flushed for every interval
+        # 'shared': a single KP for all alert names, flushed once per
+        # interval, and not flushed for intervals without alerts
+        'flush_mode': 'per-alert',
     }
 
     level_values = {
@@ -31,11 +89,33 @@ class TimeseriesConsumer(AbstractConsumer):
         self.alert_state = {}
         self.ts = None
         self.no_alert_timeout = self.config['alert_reset_timeout']
+        if self.config['flush_mode'] not in ('per-alert', 'shared'):
+            raise ValueError("Unknown flush mode '%s'"
+                             % self.config['flush_mode'])
+        self.shared = self.config['flush_mode'] == 'shared'
+        self.series_cnt = 0
+        self.rejected_series = 0
+        self.last_checkpoint = None
 
     def start(self):
         # [alert.name] => 'int_start', 'last_time', 'kp'
         self._init_ts()
         logging.debug("Missed alert timeout: %s" % self.no_alert_timeout)
+        if self.config['checkpoint_path']:
+            self._restore_checkpoint()
+
+    def stop(self):
+        if self.config['checkpoint_path'] and self.ts is not None:
+            self._write_checkpoint(int(time.time()))
+
+    def needs_name_order(self):
+        return True
+
+    def buffers_alerts(self):
+        # values are only written when the KPs are flushed on timers (not on
+        # shutdown, so alerts handled since the last timer are redelivered
+        # after a restart)
+        return True
 
     def _init_ts(self):
         logging.info("Initializing PyTimeseries")
@@ -50,66 +130,177 @@ class TimeseriesConsumer(AbstractConsumer):
 
         logging.debug("Creating new Key Package")
 
+    def _new_state(self, int_start, last_time):
+        return {
+            'int_start': int_start,
+            'last_time': last_time,
+            'kp': self.ts.new_keypackage(reset=False),
+            # (alert fqid, meta fqid) => Series
+            'series': {},
+            # (alert fqid, meta fqid) => violation_last_time
+            'violations_last_times': {},
+            # min-heap of (reset time, series), see _reset_violations_level
+            'expiry': [],
+            # series that have an entry in the expiry heap
+            'expiring': set(),
+            # series back at normal => time they got there, oldest first
+            'normal_since': collections.OrderedDict(),
+            # indices of KP keys whose series have been evicted
+            'dead_keys': set(),
+        }
+
     def handle_alert(self, alert):
-        # get the state for this alert type
-        if alert.name in self.alert_state:
-            state = self.alert_state[alert.name]
-        else:
-            state = {
-                'int_start': self.compute_interval_start(alert.time),
-                'last_time': alert.time,
-                'kp': self.ts.new_keypackage(reset=False),
-                'violations_last_times': {}  # violation_idx: violation_last_time
-            }
-            self.alert_state[alert.name] = state
+        # get the state for this alert type (or all of them)
+        name = ALL_ALERTS if self.shared else alert.name
+        state = self.alert_state.get(name)
+        if state is None:
+            state = self._new_state(self.compute_interval_start(alert.time),
+                                    alert.time)
+            self.alert_state[name] = state
 
         self._maybe_flush_kp(state, alert.time)
 
         # we need meta, so make sure it is loaded
         alert.annotate_violations()
-        not_updated_viols = dict(state['violations_last_times'])
+        kp = state['kp']
+        series_map = state['series']
+        last_times = state['violations_last_times']
+        expiring = state['expiring']
+        normal_since = state['normal_since']
+        normal = alert.level == 'normal'
         for v in alert.violations:
             if v.meta is None:
                 continue
 
-            # create the alert_level metric
-            key = self._build_key(alert, v, self.config['level_leaf'])
-            # logging.debug("Key: %s" % key)
-            idx = state['kp'].get_key(key)
-            if idx is None:
-                idx = state['kp'].add_key(key)
-            state['kp'].set(idx, self.level_values[alert.level])
-            # Update last modified time for this metric
-            state['violations_last_times'][key] = alert.time
-            not_updated_viols.pop(key, None)
-
-            # create the delta_pct leaf
-            key = self._build_key(alert, v, self.config['delta_leaf'])
-            # logging.debug("Key: %s" % key)
-            idx = state['kp'].get_key(key)
-            if idx is None:
-                idx = state['kp'].add_key(key)
+            sid = (alert.fqid, v.meta['fqid'])
+            series = series_map.get(sid)
+            if series is None:
+                series = self._add_series(state, sid)
+                if series is None:
+                    continue
+
+            # the alert_level metric (looked up here, so that alerts at other
+            # levels are fine as long as they have no violations)
+            level = self.level_values[alert.level]
+            kp.set(series.level_idx, level)
+            series.level = level
+
+            # the delta_pct leaf
             delta_pct = 0
-            if alert.level != 'normal':
+            if not normal:
                 # compute percentage drop then * 100 to allow storage in int
                 delta_pct = int((abs(v.history_value - v.value) / max(v.history_value, v.value)) * 100 * 100)
-            state['kp'].set(idx, delta_pct)
-            # Update last modified time for this metric
-            state['violations_last_times'][key] = alert.time
-            not_updated_viols.pop(key, None)
+            kp.set(series.delta_idx, delta_pct)
+            series.delta = delta_pct
+
+            # Update last modified time for this series
+            last_times[sid] = alert.time
+            if normal:
+                if sid not in normal_since:
+                    normal_since[sid] = alert.time
+            elif sid in normal_since:
+                del normal_since[sid]
+            if sid not in expiring and self.no_alert_timeout:
+                self._schedule_reset(state, sid, alert.time)
+
+        self._reset_violations_level(state, alert.time)
+
+    def _add_series(self, state, sid):
+        """Start tracking a series, adding its level and delta keys to the
+        KP. Returns None if max_series is reached and no series can be
+        evicted to make room for it."""
+        if self.config['max_series'] and \
+                self.series_cnt >= self.config['max_series'] and \
+                not self._evict_oldest_normal():
+            if not self.rejected_series:
+                logging.warning("Tracking the maximum of %d timeseries "
+                                "series, ignoring new ones"
+                                % self.config['max_series'])
+            self.rejected_series += 1
+            return None
+        series = Series(
+            self._get_kp_key(state, self._build_key(sid, self.config['level_leaf'])),
+            self._get_kp_key(state, self._build_key(sid, self.config['delta_leaf'])))
+        state['series'][sid] = series
+        self.series_cnt += 1
+        return series
+
+    def _get_kp_key(self, state, key):
+        idx = state['kp'].get_key(key)
+        if idx is None:
+            return state['kp'].add_key(key)
+        # the key of an evicted series that is back
+        state['dead_keys'].discard(idx)
+        return idx
+
+    def _evict(self, state, sid, reason):
+        """Stop tracking a series that is at normal level. Its keys stay in
+        the KP (at normal level) until it is compacted."""
+        series = state['series'].pop(sid)
+        state['violations_last_times'].pop(sid, None)
+        state['normal_since'].pop(sid, None)
+        state['dead_keys'].update((series.level_idx, series.delta_idx))
+        self.series_cnt -= 1
+        EVICTED_SERIES.labels(reason).inc()
+
+    def _evict_oldest_normal(self):
+        oldest = None
+        for state in self.alert_state.values():
+            if state['normal_since']:
+                sid, since = next(iter(state['normal_since'].items()))
+                if oldest is None or since < oldest[2]:
+                    oldest = (state, sid, since)
+        if oldest is None:
+            return False
+        self._evict(oldest[0], oldest[1], 'max_series')
+        return True
+
+    def _evict_stale(self, state, now):
+        """Drop series that have been at normal level for longer than
+        series_retention"""
+        retention = self.config['series_retention']
+        if not retention:
+            return
+        normal_since = state['normal_since']
+        while normal_since:
+            sid, since = next(iter(normal_since.items()))
+            if now - since < retention:
+                break
+            self._evict(state, sid, 'retention')
 
-        self._reset_violations_level(not_updated_viols, state['kp'], alert.time)
+    def _maybe_compact(self, name, state):
+        """Rebuild the KP without the keys of evicted series once enough of
+        its keys are dead"""
+        dead = len(state['dead_keys'])
+        if dead < self.config['compact_min_dead_keys'] or \
+                dead < self.config['compact_dead_ratio'] * \
+                (dead + 2 * len(state['series'])):
+            return
+        logging.info("Compacting KP for %s (%d of %d keys are dead)"
+                     % (name, dead, dead + 2 * len(state['series'])))
+        kp = self.ts.new_keypackage(reset=False)
+        for sid, series in state['series'].items():
+            series.level_idx = kp.add_key(
+                self._build_key(sid, self.config['level_leaf']))
+            kp.set(series.level_idx, series.level)
+            series.delta_idx = kp.add_key(
+                self._build_key(sid, self.config['delta_leaf']))
+            kp.set(series.delta_idx, series.delta)
+        state['kp'] = kp
+        state['dead_keys'].clear()
 
-    def _build_key(self, alert, violation, leaf):
+    def _build_key(self, sid, leaf):
         # "projects.ioda.alerts.[ALERT-FQID].[META-FQID].alert_level
         return '.'\
-            .join((self.config['metric_prefix'], alert.fqid,
-                   violation.meta['fqid'],
+            .join((self.config['metric_prefix'], sid[0], sid[1],
                    leaf)).encode()
 
     def _maybe_flush_kp(self, state, time):
         this_int_start = self.compute_interval_start(time)
         if time < state['last_time']:
+            if self.shared:
+                # alerts with different names need not be in time order
+                return
             logging.error('Time is going backwards! Time: %d Last Time: %d'
                           % (time, state['last_time']))
             return
@@ -120,6 +311,13 @@ class TimeseriesConsumer(AbstractConsumer):
         if this_int_start <= state['int_start']:
             return
 
+        if self.shared:
+            # flush the interval we have been updating, skipping any idle
+            # intervals since (the values are kept for the next flush)
+            state['kp'].flush(state['int_start'])
+            state['int_start'] = this_int_start
+            return
+
         while state['int_start'] < this_int_start:
             state['kp'].flush(state['int_start'])
             state['int_start'] += self.config['interval']
@@ -127,6 +325,12 @@ class TimeseriesConsumer(AbstractConsumer):
     def compute_interval_start(self, time):
         return int(time / self.config['interval']) * self.config['interval']
 
+    def handle_alerts(self, alerts):
+        # look up the entities for the whole batch at once
+        Alert.annotate_alerts(alerts)
+        for alert in alerts:
+            self.handle_alert(alert)
+
     def handle_error(self, error):
         pass
 
@@ -136,19 +340,171 @@ class TimeseriesConsumer(AbstractConsumer):
         for name, state in self.alert_state.items():
             logging.debug("Flushing KP for %s" % name)
 
-            self._reset_violations_level(state['violations_last_times'], state['kp'], now)
+            self._reset_violations_level(state, now)
             state['kp'].flush(state['int_start'])
+            self._evict_stale(state, now)
+            self._maybe_compact(name, state)
+            SERIES.labels(name).set(len(state['series']))
+            KP_KEYS.labels(name).set(
+                2 * len(state['series']) + len(state['dead_keys']))
+        # every KP has now been written with the values of every alert
+        self.release_acks()
+        if self.config['checkpoint_path'] and \
+                (self.last_checkpoint is None or now - self.last_checkpoint
+                 >= self.config['checkpoint_interval']):
+            self._write_checkpoint(now)
+        if self.rejected_series:
+            logging.warning("Ignored %d new timeseries series (max_series "
+                            "reached)" % self.rejected_series)
+            self.rejected_series = 0
+
+    def _schedule_reset(self, state, sid, last_time):
+        heapq.heappush(state['expiry'],
+                       (last_time + self.no_alert_timeout, sid))
+        state['expiring'].add(sid)
 
-    def _reset_violations_level(self, violations, kp, now):
+    def _reset_violations_level(self, state, now):
         """Reset level of a series to normal when no violation of it is received
         for too long, assuming it has came back to normal.
 
-        :param dict violations:
+        Series are kept in a heap ordered by the time they were due to be
+        reset when they were scheduled, and are only rescheduled (once) when
+        they reach the top of it, so this costs O(log n) per series that is
+        actually due rather than a scan of every series.
+
+        :param dict state:
         :param int now:
         """
         if not self.no_alert_timeout:
             return
-        for key, last_time in violations.items():
-            if now - last_time >= self.no_alert_timeout:
-                idx = kp.get_key(key)
-                kp.set(idx, self.level_values['normal'])
+        expiry = state['expiry']
+        last_times = state['violations_last_times']
+        kp = state['kp']
+        series_map = state['series']
+        normal_since = state['normal_since']
+        normal = self.level_values['normal']
+        while expiry and expiry[0][0] <= now:
+            _, sid = heapq.heappop(expiry)
+            last_time = last_times.get(sid)
+            if last_time is None:
+                # evicted
+                state['expiring'].discard(sid)
+                continue
+            reset_time = last_time + self.no_alert_timeout
+            if reset_time > now:
+                # updated since it was scheduled
+                heapq.heappush(expiry, (reset_time, sid))
+                continue
+            state['expiring'].discard(sid)
+            series = series_map[sid]
+            kp.set(series.level_idx, normal)
+            kp.set(series.delta_idx, normal)
+            series.level = series.delta = normal
+            if sid not in normal_since:
+                normal_since[sid] = now
+
+    def _write_checkpoint(self, now):
+        """Atomically replace the checkpoint file with a snapshot of the
+        state of every alert name"""
+        path = self._checkpoint_path()
+        snapshot = {
+            'version': CHECKPOINT_VERSION,
+            'time': now,
+            'alerts': {
+                name: {
+                    'int_start': state['int_start'],
+                    'last_time': state['last_time'],
+                    # [alert fqid, meta fqid, level, delta, last time,
+                    #  time it got back to normal]
+                    'series': [
+                        [sid[0], sid[1], series.level, series.delta,
+                         state['violations_last_times'].get(sid),
+                         state['normal_since'].get(sid)]
+                        for sid, series in state['series'].items()],
+                } for name, state in self.alert_state.items()},
+        }
+        start = time.time()
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(path)),
+                prefix='.' + os.path.basename(path) + '.')
+            try:
+                with os.fdopen(fd, 'w') as fh:
+                    json.dump(snapshot, fh, separators=(',', ':'))
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except (OSError, TypeError, ValueError) as e:
+            logging.error("Failed to write timeseries checkpoint '%s': %s"
+                          % (path, e))
+            return
+        self.last_checkpoint = now
+        logging.debug("Wrote timeseries checkpoint of %d series in %.3fs"
+                      % (self.series_cnt, time.time() - start))
+
+    def _checkpoint_path(self):
+        path = self.config['checkpoint_path']
+        if self.worker_id is None:
+            return path
+        root, ext = os.path.splitext(path)
+        return "%s.%d%s" % (root, self.worker_id, ext)
+
+    def _restore_checkpoint(self):
+        path = self._checkpoint_path()
+        start = time.time()
+        try:
+            with open(path) as fh:
+                snapshot = json.load(fh)
+        except FileNotFoundError:
+            logging.info("No timeseries checkpoint at '%s'" % path)
+            return
+        except (OSError, ValueError) as e:
+            logging.error("Failed to read timeseries checkpoint '%s': %s"
+                          % (path, e))
+            return
+        if snapshot.get('version') != CHECKPOINT_VERSION:
+            logging.error("Ignoring timeseries checkpoint '%s' with "
+                          "unsupported version %s"
+                          % (path, snapshot.get('version')))
+            return
+
+        for name, saved in snapshot['alerts'].items():
+            if self.shared != (name == ALL_ALERTS):
+                logging.warning("Ignoring checkpointed state of '%s' (written "
+                                "with a different flush_mode)" % name)
+                continue
+            state = self._new_state(saved['int_start'], saved['last_time'])
+            kp = state['kp']
+            normal_since = []
+            for afqid, mfqid, level, delta, last_time, since in \
+                    saved['series']:
+                sid = (afqid, mfqid)
+                series = Series(
+                    kp.add_key(self._build_key(sid, self.config['level_leaf'])),
+                    kp.add_key(self._build_key(sid, self.config['delta_leaf'])))
+                kp.set(series.level_idx, level)
+                kp.set(series.delta_idx, delta)
+                series.level = level
+                series.delta = delta
+                state['series'][sid] = series
+                if last_time is not None:
+                    state['violations_last_times'][sid] = last_time
+                    if self.no_alert_timeout:
+                        state['expiry'].append(
+                            (last_time + self.no_alert_timeout, sid))
+                        state['expiring'].add(sid)
+                if since is not None:
+                    normal_since.append((since, sid))
+            heapq.heapify(state['expiry'])
+            normal_since.sort()
+            state['normal_since'].update((sid, since)
+                                         for since, sid in normal_since)
+            self.alert_state[name] = state
+            self.series_cnt += len(state['series'])
+        logging.info("Restored %d timeseries series for %d alert names from "
+                     "'%s' (snapshot time %d) in %.3fs"
+                     % (self.series_cnt, len(self.alert_state), path,
+                        snapshot['time'], time.time() - start))
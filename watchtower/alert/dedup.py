@@ -0,0 +1,77 @@
+import collections
+import time
+
+
+def fingerprint(alert):
+    """Identifies an alert by its fqid, time, level and violations"""
+    return hash((alert.fqid, alert.time, alert.level,
+                 tuple(v.expression for v in alert.violations)))
+
+
+class Deduplicator:
+    """Remembers the fingerprints of recently seen alerts, so that alerts
+    delivered more than once (e.g. producer retries, or redelivery after a
+    consumer group rebalance) can be dropped before any plugin handles them.
+
+    Fingerprints are remembered for window seconds after they were first
+    seen, and at most max_size of them are kept (oldest first out).
+    """
+
+    defaults = {
+        'enabled': False,
+        'window': 3600,
+        'max_size': 100000,
+    }
+
+    def __init__(self, window=None, max_size=None):
+        self.window = window if window is not None \
+            else self.defaults['window']
+        self.max_size = max_size if max_size is not None \
+            else self.defaults['max_size']
+
+        # fingerprint => time first seen, oldest first
+        self._seen = collections.OrderedDict()
+
+        self.checked = 0
+        self.duplicates = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Returns None if deduplication is not enabled"""
+        cfg = dict(cls.defaults)
+        if config:
+            cfg.update(config)
+        if not cfg.pop('enabled'):
+            return None
+        return cls(**cfg)
+
+    def is_duplicate(self, alert):
+        """Check whether the alert has been seen within the window, and
+        remember it if not"""
+        now = time.monotonic()
+        seen = self._seen
+        # forget fingerprints that have left the window
+        while seen:
+            fp, first_seen = next(iter(seen.items()))
+            if now - first_seen < self.window:
+                break
+            seen.popitem(last=False)
+
+        self.checked += 1
+        fp = fingerprint(alert)
+        if fp in seen:
+            self.duplicates += 1
+            return True
+        seen[fp] = now
+        if len(seen) > self.max_size:
+            seen.popitem(last=False)
+        return False
+
+    def stats(self):
+        return {
+            'size': len(self._seen),
+            'checked': self.checked,
+            'duplicates': self.duplicates,
+            'hit_rate': self.duplicates / self.checked
+            if self.checked else 0.0,
+        }
@@ -0,0 +1,468 @@
+import collections
+import concurrent.futures
+import json
+import logging
+import requests
+import requests.adapters
+import sqlite3
+import threading
+import time
+
+# returned by EntityCache.get when there is no (live) entry for a key
+MISSING = object()
+
+
+class EntityCache:
+    """Process-wide cache of IODA entity metadata.
+
+    Entries are keyed on the "<entityType>/<entityCode>" expression and hold
+    either the meta dict used to annotate violations, or None when IODA told
+    us the entity does not exist (negative caching). The in-memory store is an
+    LRU bounded by max_size, and every entry expires after ttl (or
+    negative_ttl) seconds. If path is set, entries are also written to a
+    sqlite database so that a restarted consumer starts warm. New entries are
+    written behind, by a background thread, in one transaction every
+    write_interval seconds, so that lookups never wait on the disk (or on
+    other processes using the same file).
+    """
+
+    defaults = {
+        'max_size': 100000,
+        'ttl': 86400,
+        'negative_ttl': 3600,
+        'path': None,
+        'write_interval': 1,
+    }
+
+    def __init__(self, max_size=None, ttl=None, negative_ttl=None, path=None,
+                 write_interval=None):
+        self.max_size = max_size if max_size is not None \
+            else self.defaults['max_size']
+        self.ttl = ttl if ttl is not None else self.defaults['ttl']
+        self.negative_ttl = negative_ttl if negative_ttl is not None \
+            else self.defaults['negative_ttl']
+        self.path = path
+        self.write_interval = write_interval if write_interval is not None \
+            else self.defaults['write_interval']
+
+        # key => (meta, expiry_time)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        # entries not yet written to the db: key => (meta, expiry)
+        self._dirty = {}
+        # held while using the db, never while holding _lock
+        self._db_lock = threading.Lock()
+        self._writer = None
+        self._writer_stop = threading.Event()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.written = 0
+
+        if self.path:
+            self._open_db()
+
+    @classmethod
+    def from_config(cls, config):
+        cfg = dict(cls.defaults)
+        if config:
+            cfg.update(config)
+        return cls(**cfg)
+
+    def _open_db(self):
+        logging.info("Loading IODA entity cache from '%s'" % self.path)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS entity_cache ("
+                         "key TEXT PRIMARY KEY, meta TEXT, expiry REAL)")
+        now = time.time()
+        self._db.execute("DELETE FROM entity_cache WHERE expiry <= ?", (now,))
+        self._db.commit()
+        # load the most recently written entries last so that they end up at
+        # the MRU end of the LRU
+        rows = self._db.execute(
+            "SELECT key, meta, expiry FROM entity_cache "
+            "ORDER BY expiry DESC LIMIT ?", (self.max_size,)).fetchall()
+        for key, meta, expiry in reversed(rows):
+            self._entries[key] = (json.loads(meta), expiry)
+        logging.info("Loaded %d IODA entities from cache" % len(rows))
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name='entity-cache-writer',
+                                        daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        while not self._writer_stop.wait(self.write_interval):
+            self.flush()
+
+    def flush(self):
+        """Write the entries added since the last flush to the db"""
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+        if not dirty:
+            return
+        rows = [(key, json.dumps(meta), expiry)
+                for key, (meta, expiry) in dirty.items()]
+        with self._db_lock:
+            if self._db is None:
+                return
+            try:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO entity_cache VALUES (?, ?, ?)",
+                        rows)
+                self.written += len(rows)
+            except sqlite3.Error as e:
+                logging.error("Could not persist %d IODA entities: %s"
+                              % (len(rows), e))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            meta, expiry = entry
+            if expiry <= time.time():
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            if meta is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return meta
+
+    def put(self, key, meta):
+        expiry = time.time() + (self.ttl if meta is not None
+                                else self.negative_ttl)
+        with self._lock:
+            self._entries[key] = (meta, expiry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            if self._writer is not None:
+                self._dirty[key] = (meta, expiry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dirty.clear()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.execute("DELETE FROM entity_cache")
+                self._db.commit()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer_stop.set()
+            self._writer.join()
+            self._writer = None
+        self.flush()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'written': self.written,
+            'hit_rate': (self.hits + self.negative_hits) / lookups
+            if lookups else 0.0,
+        }
+
+
+class EntityClient:
+    """Client for the IODA entity API.
+
+    All lookups share a single keep-alive requests.Session and run on a
+    bounded thread pool, so annotating an alert takes about as long as its
+    slowest lookup rather than the sum of them. Lookups that have not
+    completed by the deadline are abandoned by the caller, but still fill the
+    cache once they finish.
+
+    Concurrent lookups for the same entity collapse into a single request
+    (single-flight). If bulk_size is greater than one, entities of the same
+    type are looked up together, bulk_size codes per request, and if linger
+    is set, lookups that arrive within linger seconds of each other (e.g.
+    from a burst of alerts during a large outage) are coalesced into the same
+    bulk requests.
+    """
+
+    defaults = {
+        'api_url': "https://api.ioda.inetintel.cc.gatech.edu/v2/entities",
+        'max_concurrency': 16,
+        'pool_size': 16,
+        'timeout': 10,
+        'deadline': 30,
+        'bulk_size': 1,
+        'linger': 0,
+    }
+
+    def __init__(self, api_url=None, max_concurrency=None, pool_size=None,
+                 timeout=None, deadline=None, bulk_size=None, linger=None,
+                 cache=None):
+        self.api_url = api_url or self.defaults['api_url']
+        self.max_concurrency = max_concurrency \
+            or self.defaults['max_concurrency']
+        self.timeout = timeout if timeout is not None \
+            else self.defaults['timeout']
+        self.deadline = deadline if deadline is not None \
+            else self.defaults['deadline']
+        self.bulk_size = max(bulk_size or self.defaults['bulk_size'], 1)
+        self.linger = linger if linger is not None \
+            else self.defaults['linger']
+        pool_size = pool_size or self.defaults['pool_size']
+        self.cache = cache
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = None
+
+        # "type/code" => Future, for every lookup that is queued or running
+        self._inflight = {}
+        self._lock = threading.Lock()
+        # (type, code) waiting to be dispatched by the linger thread
+        self._pending = []
+        self._pending_cond = threading.Condition(self._lock)
+        self._dispatcher = None
+
+        self.queries = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.deadline_exceeded = 0
+        # codes missing from bulk responses, looked up one at a time
+        self.bulk_fallbacks = 0
+
+    @classmethod
+    def from_config(cls, config, cache=None):
+        cfg = dict(cls.defaults)
+        if config:
+            cfg.update(config)
+        return cls(cache=cache, **cfg)
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_concurrency,
+                thread_name_prefix='entity-lookup')
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.session.close()
+
+    def lookup(self, entities):
+        """Look up the meta for a collection of (type, code) entities.
+
+        Returns a dict mapping "type/code" to either the meta dict, or None if
+        IODA does not know about the entity. Entities whose lookup failed or
+        did not finish before the deadline are not included.
+        """
+        futures = {}
+        new = []
+        with self._lock:
+            for ent in set(entities):
+                key = _key(*ent)
+                fut = self._inflight.get(key)
+                if fut is not None:
+                    self.coalesced += 1
+                else:
+                    fut = concurrent.futures.Future()
+                    self._inflight[key] = fut
+                    new.append(ent)
+                futures[fut] = key
+            if new and self.linger:
+                self._pending.extend(new)
+                self._ensure_dispatcher()
+                self._pending_cond.notify()
+        if new and not self.linger:
+            self._dispatch(new, inline=True)
+
+        done, not_done = concurrent.futures.wait(futures,
+                                                 timeout=self.deadline)
+        if not_done:
+            self.deadline_exceeded += len(not_done)
+            logging.error("%d IODA entity lookups did not complete within "
+                          "%ss" % (len(not_done), self.deadline))
+
+        metas = {}
+        for fut in done:
+            meta = fut.result()
+            if meta is not MISSING:
+                metas[futures[fut]] = meta
+        return metas
+
+    def _ensure_dispatcher(self):
+        # must be called with self._lock held
+        if self._dispatcher is None or not self._dispatcher.is_alive():
+            self._dispatcher = threading.Thread(target=self._dispatch_loop,
+                                                name='entity-dispatch',
+                                                daemon=True)
+            self._dispatcher.start()
+
+    def _dispatch_loop(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._pending_cond.wait()
+            # give other alerts a chance to add their lookups to this batch
+            time.sleep(self.linger)
+            with self._lock:
+                pending = self._pending
+                self._pending = []
+            self._dispatch(pending)
+
+    def _dispatch(self, entities, inline=False):
+        if inline and len(entities) == 1:
+            # the calling thread would only wait on a single request anyway
+            self._resolve_chunk(entities[0][0], [entities[0][1]])
+            return
+        by_type = collections.defaultdict(list)
+        for enttype, entcode in entities:
+            by_type[enttype].append(entcode)
+        for enttype, codes in by_type.items():
+            for i in range(0, len(codes), self.bulk_size):
+                self.executor.submit(self._resolve_chunk, enttype,
+                                     codes[i:i + self.bulk_size])
+
+    def _resolve_chunk(self, enttype, entcodes):
+        try:
+            metas = self.query_many(enttype, entcodes)
+            if metas is not None and len(entcodes) > 1:
+                # only a single-code query can tell that an entity does not
+                # exist, since the API may not echo back every code we asked
+                # for in a bulk query (or may not support them at all)
+                for entcode in entcodes:
+                    if entcode not in metas:
+                        self.bulk_fallbacks += 1
+                        metas.update(self.query_many(enttype, [entcode])
+                                     or {})
+        except Exception as e:
+            logging.exception(e)
+            metas = None
+        metas = metas or {}
+        for entcode in entcodes:
+            key = _key(enttype, entcode)
+            meta = metas.get(entcode, MISSING)
+            if meta is not MISSING and self.cache is not None:
+                self.cache.put(key, meta)
+            with self._lock:
+                fut = self._inflight.pop(key, None)
+            if fut is not None:
+                fut.set_result(meta)
+
+    def query(self, enttype, entcode):
+        """Look up the meta for a single entity.
+
+        Returns the meta dict, None if IODA does not know about the entity, or
+        MISSING if the lookup failed and should be retried later.
+        """
+        return (self.query_many(enttype, [entcode]) or {}).get(entcode,
+                                                               MISSING)
+
+    def query_many(self, enttype, entcodes):
+        """Look up the meta for several entities of the same type in one
+        request.
+
+        Returns a dict mapping each code to its meta dict, or (for a
+        single-code query only) None if IODA does not know about the entity.
+        Codes missing from a bulk response are left out, since we can't tell
+        whether they exist. Returns None if the request fails.
+        """
+        exp = (enttype, ",".join(entcodes))
+        self.queries += 1
+        try:
+            resp = self.session.get(self.api_url + "/query",
+                                    params={'entityType': enttype,
+                                            'entityCode': exp[1]},
+                                    timeout=self.timeout)
+        except requests.RequestException as e:
+            self.failures += 1
+            logging.error('IODA entity annotation %s failed: %s' % (exp, e))
+            return None
+        if not 200 <= resp.status_code < 300:
+            # e.g. the API is down, which says nothing about the entities
+            self.failures += 1
+            logging.error('IODA entity annotation %s failed with HTTP %d: %s'
+                          % (exp, resp.status_code, resp.text[:200]))
+            return None
+        try:
+            res = resp.json()
+        except Exception as e:
+            self.failures += 1
+            logging.error('IODA entity annotation %s failed with JSON decode error: %s' % (exp, e))
+            return None
+
+        if not res or 'data' not in res:
+            self.failures += 1
+            logging.error('IODA entity annotation %s failed with error: %s' %
+                          (exp, res.get('error') if res else None))
+            return None
+
+        metas = {}
+        parse_failed = False
+        for entity in res['data'] or []:
+            try:
+                meta = _parse_entity(entity)
+            except Exception as e:
+                logging.error('Unable to parse IODA entity annotation %s: %s' % (exp, e))
+                parse_failed = True
+                continue
+            if len(entcodes) == 1:
+                # the API may not echo back exactly the code we asked for
+                metas[entcodes[0]] = meta
+                break
+            metas[meta['meta_code']] = meta
+        if parse_failed or len(entcodes) > 1:
+            # we can't tell whether the missing entities exist or not
+            return metas
+        if entcodes[0] not in metas:
+            logging.error('IODA entity annotation %s failed with error: %s' %
+                          (exp, res.get('error')))
+            metas[entcodes[0]] = None
+        return metas
+
+    def stats(self):
+        return {
+            'queries': self.queries,
+            'failures': self.failures,
+            'coalesced': self.coalesced,
+            'deadline_exceeded': self.deadline_exceeded,
+            'bulk_fallbacks': self.bulk_fallbacks,
+        }
+
+
+def _key(enttype, entcode):
+    return enttype + "/" + entcode
+
+
+def _parse_entity(entity):
+    return {
+        "meta_type": entity["type"],
+        "fqid": entity["attrs"]["fqid"],
+        "meta_code": entity["code"]
+    }
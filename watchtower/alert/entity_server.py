@@ -0,0 +1,88 @@
+import argparse
+import http.server
+import json
+import logging
+import threading
+import urllib.parse
+
+
+class _EntityHandler(http.server.BaseHTTPRequestHandler):
+
+    # (type, code) => fqid
+    entities = {}
+    bulk = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if not url.path.endswith('/query'):
+            self.send_error(404)
+            return
+        params = urllib.parse.parse_qs(url.query)
+        enttype = params.get('entityType', [''])[0]
+        codes = params.get('entityCode', [''])[0]
+        codes = codes.split(',') if self.bulk else [codes]
+        data = [{
+            'type': enttype,
+            'code': code,
+            'attrs': {'fqid': self.entities[(enttype, code)]},
+        } for code in codes if (enttype, code) in self.entities]
+        self.server.queries += 1
+        body = json.dumps({'data': data, 'error': None}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Entity API request: " + format % args)
+
+
+def start_entity_server(entities, port=0, host='127.0.0.1', bulk=True):
+    """Serve a stand-in for the IODA entity API's /query endpoint from a
+    background thread, for testing EntityClient without IODA.
+
+    entities maps (type, code) to the entity's fqid. Unless bulk is set,
+    entityCode is taken as a single code (even if it contains commas), as an
+    API without bulk queries would. The server's queries attribute counts
+    the requests it has answered, and its api_url is what to configure as
+    entity_api.api_url.
+    """
+    handler = type('EntityHandler', (_EntityHandler,),
+                   {'entities': dict(entities), 'bulk': bulk})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.queries = 0
+    server.api_url = "http://%s:%d" % server.server_address[:2]
+    thread = threading.Thread(target=server.serve_forever,
+                              name='entity-http', daemon=True)
+    thread.start()
+    logging.info("Serving stand-in entity API on %s/query" % server.api_url)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+    Serves a stand-in for the IODA entity API, for testing.
+    """)
+    parser.add_argument('-e', '--entities', nargs='?', required=True,
+                        help='JSON file of {"type/code": fqid} entities')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('--no-bulk', action='store_true',
+                        help='Do not accept comma-separated entity codes')
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(opts.entities) as fentities:
+        entities = {tuple(key.split("/", 1)): fqid
+                    for key, fqid in json.load(fentities).items()}
+    server = start_entity_server(entities, opts.port, host='',
+                                 bulk=not opts.no_bulk)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
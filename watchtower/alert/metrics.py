@@ -0,0 +1,408 @@
+import bisect
+import http.server
+import logging
+import os
+import resource
+import threading
+import time
+
+# default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10, 30, 60)
+
+
+def _fmt_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+def _fmt_value(v):
+    if v == float('inf'):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        # metrics without labels have a single, unlabeled child
+        return self.labels()
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child):
+        return ["%s%s %s" % (self.name, _fmt_labels(self.labelnames, values),
+                             _fmt_value(child.value))]
+
+
+class _Value:
+
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    @property
+    def value(self):
+        return self._default().value
+
+
+class Gauge(Counter):
+
+    type = 'gauge'
+
+    def set(self, value):
+        self._default().set(value)
+
+
+class _HistogramValue:
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket holding it"""
+        if not self.count:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for bound, cnt in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += cnt
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+
+class _Timer:
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Histogram(_Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, cnt in zip(self.buckets + (float('inf'),), child.counts):
+            cumulative += cnt
+            lines.append("%s_bucket%s %d" % (
+                self.name,
+                _fmt_labels(self.labelnames, values, ('le', _fmt_value(bound))),
+                cumulative))
+        labels = _fmt_labels(self.labelnames, values)
+        lines.append("%s_sum%s %s" % (self.name, labels, _fmt_value(child.sum)))
+        lines.append("%s_count%s %d" % (self.name, labels, child.count))
+        return lines
+
+
+class Registry:
+    """A set of metrics, rendered in the Prometheus text exposition format.
+
+    Collectors are callables run just before rendering, which can be used to
+    update gauges from state that is owned elsewhere (e.g. cache stats).
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def _get(self, clz, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = clz(name, help, labelnames, **kwargs)
+                self.metrics[name] = metric
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logging.error("Metrics collector failed: %s" % e)
+
+    def render(self):
+        self.collect()
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+# process-wide registry
+REGISTRY = Registry()
+
+PLUGIN_ALERTS = REGISTRY.counter(
+    'watchtower_alert_plugin_alerts_total',
+    'Alerts handled by each plugin', ['plugin'])
+PLUGIN_VIOLATIONS = REGISTRY.counter(
+    'watchtower_alert_plugin_violations_total',
+    'Violations handled by each plugin', ['plugin'])
+PLUGIN_ERRORS = REGISTRY.counter(
+    'watchtower_alert_plugin_errors_total',
+    'Exceptions raised by each plugin', ['plugin'])
+PLUGIN_HANDLE_SECONDS = REGISTRY.histogram(
+    'watchtower_alert_plugin_handle_seconds',
+    'Time each plugin takes to handle an alert (or batch of alerts)',
+    ['plugin'])
+PLUGIN_TIMER_SECONDS = REGISTRY.histogram(
+    'watchtower_alert_plugin_timer_seconds',
+    'Time each plugin takes to handle a timer (e.g. flushes)', ['plugin'])
+KAFKA_POLL_SECONDS = REGISTRY.histogram(
+    'watchtower_alert_kafka_poll_seconds',
+    'Time spent waiting for messages from Kafka')
+KAFKA_MESSAGES = REGISTRY.counter(
+    'watchtower_alert_kafka_messages_total',
+    'Messages consumed from Kafka')
+KAFKA_CONSUMER_LAG = REGISTRY.gauge(
+    'watchtower_alert_kafka_consumer_lag',
+    'Messages between the consumer position and the end of the partition',
+    ['topic', 'partition'])
+DUPLICATE_ALERTS = REGISTRY.counter(
+    'watchtower_alert_duplicate_alerts_total',
+    'Alerts dropped because they had already been seen')
+PROCESS_RESIDENT_MEMORY = REGISTRY.gauge(
+    'process_resident_memory_bytes', 'Resident memory size in bytes')
+
+
+def _collect_process_memory():
+    try:
+        with open('/proc/self/statm') as fstatm:
+            rss_pages = int(fstatm.read().split()[1])
+        PROCESS_RESIDENT_MEMORY.set(rss_pages * os.sysconf('SC_PAGE_SIZE'))
+    except (OSError, ValueError):
+        # no /proc: fall back to the peak RSS (in KB on most systems)
+        PROCESS_RESIDENT_MEMORY.set(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+REGISTRY.add_collector(_collect_process_memory)
+
+
+class InstrumentedPlugin:
+    """Wraps a consumer plugin, recording what it handles and how long it
+    takes. All other attributes are passed through to the plugin."""
+
+    def __init__(self, name, plugin):
+        self.name = name
+        self.plugin = plugin
+        self._alerts = PLUGIN_ALERTS.labels(name)
+        self._violations = PLUGIN_VIOLATIONS.labels(name)
+        self._errors = PLUGIN_ERRORS.labels(name)
+        self._handle_seconds = PLUGIN_HANDLE_SECONDS.labels(name)
+        self._timer_seconds = PLUGIN_TIMER_SECONDS.labels(name)
+
+    def __getattr__(self, attr):
+        return getattr(self.plugin, attr)
+
+    def __repr__(self):
+        return "InstrumentedPlugin(%s)" % self.name
+
+    def _call(self, hist, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        except Exception:
+            self._errors.inc()
+            raise
+        finally:
+            hist.observe(time.perf_counter() - start)
+
+    def handle_alert(self, alert):
+        self._call(self._handle_seconds, self.plugin.handle_alert, alert)
+        self._alerts.inc()
+        self._violations.inc(len(alert.violations))
+
+    def handle_alerts(self, alerts):
+        self._call(self._handle_seconds, self.plugin.handle_alerts, alerts)
+        self._alerts.inc(len(alerts))
+        self._violations.inc(sum(len(a.violations) for a in alerts))
+
+    def handle_timer(self, now):
+        self._call(self._timer_seconds, self.plugin.handle_timer, now)
+
+
+class AsyncInstrumentedPlugin(InstrumentedPlugin):
+    """InstrumentedPlugin for AsyncAbstractConsumer plugins"""
+
+    async def _call(self, hist, func, *args):
+        start = time.perf_counter()
+        try:
+            return await func(*args)
+        except Exception:
+            self._errors.inc()
+            raise
+        finally:
+            hist.observe(time.perf_counter() - start)
+
+    async def handle_alert(self, alert):
+        await self._call(self._handle_seconds, self.plugin.handle_alert, alert)
+        self._alerts.inc()
+        self._violations.inc(len(alert.violations))
+
+    async def handle_alerts(self, alerts):
+        await self._call(self._handle_seconds, self.plugin.handle_alerts,
+                         alerts)
+        self._alerts.inc(len(alerts))
+        self._violations.inc(sum(len(a.violations) for a in alerts))
+
+    async def handle_timer(self, now):
+        await self._call(self._timer_seconds, self.plugin.handle_timer, now)
+
+
+def _fmt_seconds(v):
+    return "-" if v is None else "%ss" % _fmt_value(v)
+
+
+def summary():
+    """One-line-per-plugin summary of the plugin metrics, for logging"""
+    lines = []
+    for (name,), child in sorted(PLUGIN_HANDLE_SECONDS._children.items()):
+        lines.append(
+            "plugin %s: alerts: %d violations: %d errors: %d "
+            "handle p50/p99: <=%s/<=%s timer p99: <=%s" % (
+                name, PLUGIN_ALERTS.labels(name).value,
+                PLUGIN_VIOLATIONS.labels(name).value,
+                PLUGIN_ERRORS.labels(name).value,
+                _fmt_seconds(child.quantile(0.5)),
+                _fmt_seconds(child.quantile(0.99)),
+                _fmt_seconds(PLUGIN_TIMER_SECONDS.labels(name)
+                             .quantile(0.99))))
+    poll = KAFKA_POLL_SECONDS._default()
+    if poll.count:
+        lines.append("kafka: messages: %d poll wait: %.1fs total"
+                     % (KAFKA_MESSAGES.value, poll.sum))
+    return lines
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format % args)
+
+
+def start_http_server(port, host='', registry=REGISTRY):
+    """Serve the registry at /metrics from a background thread"""
+    handler = type('MetricsHandler', (_MetricsHandler,),
+                   {'registry': registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-http', daemon=True)
+    thread.start()
+    logging.info("Serving metrics on %s:%d/metrics" % (host or '*', port))
+    return server
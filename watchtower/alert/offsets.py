@@ -0,0 +1,172 @@
+import collections
+import logging
+import threading
+import time
+
+import confluent_kafka
+
+
+class PendingAck:
+    """Acknowledgement handle for one or more Kafka messages.
+
+    Each plugin that the messages were dispatched to calls ack() once it is
+    done with them (or fail() if it could not handle them), and the messages
+    become committable once every plugin has done so without failing.
+    """
+
+    __slots__ = ('remaining', 'failed', '_lock')
+
+    def __init__(self, remaining, lock):
+        self.remaining = remaining
+        self.failed = False
+        self._lock = lock
+
+    def ack(self):
+        with self._lock:
+            self.remaining -= 1
+
+    def handled(self, plugin):
+        """Ack on behalf of a plugin that has handled the messages, or, if it
+        buffers them, leave it to the plugin to ack once they are written"""
+        if plugin.buffers_alerts():
+            plugin.hold_ack(self)
+        else:
+            self.ack()
+
+    def fail(self):
+        with self._lock:
+            self.failed = True
+            self.remaining -= 1
+
+    def complete(self):
+        with self._lock:
+            self.remaining = 0
+
+    @property
+    def done(self):
+        return self.remaining <= 0
+
+
+class OffsetTracker:
+    """Tracks the offsets of in-flight messages for each partition and
+    commits, asynchronously and in batches, the offsets up to which every
+    message has been acknowledged by every plugin (at-least-once delivery).
+
+    Offsets are committed once at least commit_every messages have completed
+    since the last commit, or commit_interval seconds have passed.
+
+    A message that a plugin failed to handle is not committed, and nothing
+    after it in its partition is either: failed is set to its partition and
+    offset, so that the consumer can stop and have it redelivered. With
+    ack_failed, failures are instead committed like any other message (and
+    thus lost).
+    """
+
+    defaults = {
+        'commit_every': 1000,
+        'commit_interval': 5,
+        'ack_failed': False,
+    }
+
+    def __init__(self, kc, commit_every=None, commit_interval=None,
+                 ack_failed=None):
+        self.kc = kc
+        self.commit_every = commit_every or self.defaults['commit_every']
+        self.commit_interval = commit_interval \
+            or self.defaults['commit_interval']
+        self.ack_failed = ack_failed if ack_failed is not None \
+            else self.defaults['ack_failed']
+        # (topic, partition, offset) of the first message that failed
+        self.failed = None
+
+        self._lock = threading.Lock()
+        # (topic, partition) => OrderedDict(offset => PendingAck)
+        self._pending = {}
+        # (topic, partition) => next offset to commit
+        self._committable = {}
+        self._committed = {}
+        self._completed_since_commit = 0
+        self._last_commit = time.time()
+
+        self.commits = 0
+        self.commit_errors = 0
+
+    @classmethod
+    def from_config(cls, kc, config):
+        cfg = dict(cls.defaults)
+        if config:
+            cfg.update(config)
+        return cls(kc, **cfg)
+
+    def track(self, msgs, plugin_cnt):
+        """Start tracking a batch of messages that will be handled by
+        plugin_cnt plugins, returning the PendingAck that they share"""
+        pending = PendingAck(plugin_cnt, self._lock)
+        for msg in msgs:
+            tp = (msg.topic(), msg.partition())
+            self._pending.setdefault(tp, collections.OrderedDict())[
+                msg.offset()] = pending
+        return pending
+
+    def _advance(self):
+        # move the committable offset of each partition past every message
+        # at the front of its queue that is done
+        for tp, offsets in self._pending.items():
+            while offsets:
+                offset, pending = next(iter(offsets.items()))
+                if not pending.done:
+                    break
+                if pending.failed and not self.ack_failed:
+                    if self.failed is None:
+                        self.failed = (tp[0], tp[1], offset)
+                    break
+                offsets.popitem(last=False)
+                self._committable[tp] = offset + 1
+                self._completed_since_commit += 1
+
+    def maybe_commit(self, force=False, asynchronous=True):
+        self._advance()
+        if not force and \
+                self._completed_since_commit < self.commit_every and \
+                time.time() - self._last_commit < self.commit_interval:
+            return
+        offsets = [confluent_kafka.TopicPartition(tp[0], tp[1], offset)
+                   for tp, offset in self._committable.items()
+                   if self._committed.get(tp) != offset]
+        self._completed_since_commit = 0
+        self._last_commit = time.time()
+        if not offsets:
+            return
+        try:
+            self.kc.commit(offsets=offsets, asynchronous=asynchronous)
+        except confluent_kafka.KafkaException as e:
+            self.commit_errors += 1
+            logging.error("Failed to commit offsets: %s" % e)
+            return
+        self.commits += 1
+        for tp in offsets:
+            self._committed[(tp.topic, tp.partition)] = tp.offset
+        logging.debug("Committed offsets: %s"
+                      % ["%s:%d@%d" % (tp.topic, tp.partition, tp.offset)
+                         for tp in offsets])
+
+    def revoke(self, partitions):
+        """Commit what we can for partitions that are being revoked, and stop
+        tracking them (acks for their messages are then ignored)"""
+        self.maybe_commit(force=True, asynchronous=False)
+        for tp in partitions:
+            key = (tp.topic, tp.partition)
+            self._pending.pop(key, None)
+            self._committable.pop(key, None)
+            self._committed.pop(key, None)
+
+    def stats(self):
+        return {
+            'in_flight': sum(len(o) for o in self._pending.values()),
+            'committed': {"%s:%d" % tp: offset
+                          for tp, offset in self._committed.items()},
+            'commits': self.commits,
+            'commit_errors': self.commit_errors,
+            'failed': "%s:%d@%d" % self.failed
+            if self.failed is not None else None,
+        }
@@ -0,0 +1,53 @@
+import gzip
+import io
+import logging
+import mmap
+import os
+
+# optional, for .zst archives
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# size of reads from compressed archives
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def open_archive(path):
+    """Open a JSONL alert archive for reading lines of bytes.
+
+    Archives ending in .gz or .zst are decompressed on the fly using large
+    buffered reads, and plain files are memory-mapped.
+    """
+    if path.endswith('.gz'):
+        return io.BufferedReader(gzip.open(path, 'rb'),
+                                 buffer_size=READ_BUFFER_SIZE)
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError("Reading '%s' requires the zstandard package"
+                               % path)
+        fh = open(path, 'rb')
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            fh, read_size=READ_BUFFER_SIZE, closefd=True)
+        return io.BufferedReader(reader, buffer_size=READ_BUFFER_SIZE)
+    with open(path, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            # empty files can't be mapped
+            return io.BytesIO()
+        # the mapping stays valid after the file is closed
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iter_records(paths):
+    """Yield each (non-empty) line of the given archives, in order"""
+    for path in paths:
+        logging.info("Replaying alerts from '%s'" % path)
+        archive = open_archive(path)
+        try:
+            for line in iter(archive.readline, b''):
+                line = line.strip()
+                if line:
+                    yield line
+        finally:
+            archive.close()
@@ -0,0 +1,171 @@
+import fnmatch
+import re
+
+from .alert import Alert
+
+# glob match results remembered per pattern set, before starting over
+GLOB_CACHE_SIZE = 10000
+
+
+class GlobSet:
+    """A set of shell-style globs (e.g. "ping-*") compiled into one regex,
+    with the match result of each string remembered"""
+
+    def __init__(self, globs):
+        self.globs = list(globs)
+        self._regex = re.compile("|".join("(?:%s)" % fnmatch.translate(g)
+                                          for g in self.globs))
+        self._cache = {}
+
+    def match(self, s):
+        matched = self._cache.get(s)
+        if matched is None:
+            if len(self._cache) >= GLOB_CACHE_SIZE:
+                self._cache.clear()
+            matched = self._regex.match(s) is not None
+            self._cache[s] = matched
+        return matched
+
+
+def violation_meta_type(violation):
+    """The meta type of a violation's entity, which (unlike its other meta)
+    is known from its expression before the violation is annotated"""
+    if violation.meta is not None:
+        return violation.meta.get('meta_type')
+    if "/" not in violation.expression:
+        return None
+    enttype = violation.expression.split("/", 1)[0]
+    # see Alert._entity_expressions
+    if enttype in ("geoasn_country", "geoasn_region"):
+        return "geoasn"
+    return enttype
+
+
+class Route:
+    """The alerts and violations a plugin should receive.
+
+    An alert matches if its level is in levels, its name matches one of the
+    names globs and its fqid one of the fqids globs (each unset option
+    matches everything). The violations of a matching alert can be further
+    restricted by their meta type (meta_types, exclude_meta_types), value
+    (min_value, max_value) and relative drop from the history value in
+    percent (min_drop_pct). Alerts left without violations are not routed.
+    """
+
+    def __init__(self, levels=None, names=None, fqids=None, meta_types=None,
+                 exclude_meta_types=None, min_value=None, max_value=None,
+                 min_drop_pct=None):
+        self.levels = frozenset(levels) if levels is not None else None
+        self.names = GlobSet(names) if names is not None else None
+        self.fqids = GlobSet(fqids) if fqids is not None else None
+        self.meta_types = frozenset(meta_types) \
+            if meta_types is not None else None
+        self.exclude_meta_types = frozenset(exclude_meta_types or ())
+        self.min_value = min_value
+        self.max_value = max_value
+        self.min_drop_pct = min_drop_pct
+        # routes with the same violation filter share the filtered alert
+        self.violation_filter = (self.meta_types, self.exclude_meta_types,
+                                 min_value, max_value, min_drop_pct)
+        if self.violation_filter == (None, frozenset(), None, None, None):
+            self.violation_filter = None
+
+    def match_alert(self, alert):
+        return (self.names is None or self.names.match(alert.name)) and \
+            (self.fqids is None or self.fqids.match(alert.fqid))
+
+    def match_violation(self, v):
+        if self.meta_types is not None or self.exclude_meta_types:
+            meta_type = violation_meta_type(v)
+            if self.meta_types is not None and \
+                    meta_type not in self.meta_types:
+                return False
+            if meta_type in self.exclude_meta_types:
+                return False
+        if self.min_value is not None and \
+                (v.value is None or v.value < self.min_value):
+            return False
+        if self.max_value is not None and \
+                (v.value is None or v.value > self.max_value):
+            return False
+        if self.min_drop_pct is not None:
+            if not v.history_value or v.value is None:
+                return False
+            drop = (v.history_value - v.value) / v.history_value * 100
+            if drop < self.min_drop_pct:
+                return False
+        return True
+
+
+class Router:
+    """Decides, once per alert, which alert plugins should handle it (see
+    Route for the routing options of each plugin).
+
+    Plugins are indexed by the levels they accept, so only the routes that
+    can match an alert are checked. Violations are filtered before the
+    alert is handed to any plugin, and thus before it is annotated: a
+    plugin gets a copy of the alert with only the violations that match its
+    route, and plugins whose routes filter violations the same way share
+    that copy.
+    """
+
+    def __init__(self, plugins, routes):
+        self.plugins = list(plugins)
+        self.routes = [Route(**routes[name]) if name in routes else None
+                       for name in self.plugins]
+        # level => [(plugin index, route)] for the plugins accepting it
+        self._by_level = {
+            level: [(i, route) for i, route in enumerate(self.routes)
+                    if route is None or route.levels is None or
+                    level in route.levels]
+            for level in Alert.LEVELS}
+
+    @classmethod
+    def from_config(cls, plugins, routes):
+        """Returns None if no plugin has a route"""
+        if not any(name in routes for name in plugins):
+            return None
+        return cls(plugins, routes)
+
+    def route(self, alert):
+        """Returns the alert (or filtered copy of it) that each plugin should
+        handle, or None for the plugins that should not handle it"""
+        routed = [None] * len(self.plugins)
+        filtered = {}
+        for i, route in self._by_level.get(alert.level, ()):
+            if route is None:
+                routed[i] = alert
+                continue
+            if not route.match_alert(alert):
+                continue
+            if route.violation_filter is None:
+                routed[i] = alert
+                continue
+            if route.violation_filter not in filtered:
+                filtered[route.violation_filter] = \
+                    self._filter_violations(alert, route)
+            routed[i] = filtered[route.violation_filter]
+        return routed
+
+    def route_batch(self, alerts):
+        """Returns the list of alerts each plugin should handle"""
+        batches = [[] for _ in self.plugins]
+        for alert in alerts:
+            for batch, routed in zip(batches, self.route(alert)):
+                if routed is not None:
+                    batch.append(routed)
+        return batches
+
+    @staticmethod
+    def _filter_violations(alert, route):
+        violations = [v for v in alert.violations if route.match_violation(v)]
+        if not violations:
+            return None
+        if len(violations) == len(alert.violations):
+            return alert
+        # the violations themselves are shared, so whatever annotates them
+        # first does so for every plugin
+        return Alert.from_trusted(alert.fqid, alert.name, alert.level,
+                                  alert.time, alert.expression,
+                                  alert.history_expression, alert.method,
+                                  violations)
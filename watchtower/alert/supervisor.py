@@ -0,0 +1,108 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+
+def _worker_main(config_file, worker_id):
+    # imported here so that the supervisor itself never connects to kafka or
+    # initializes any plugins
+    from .consumer import Consumer
+    # don't inherit the supervisor's handlers, and let it decide when we
+    # stop (the consumer installs its own SIGTERM handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Consumer(config_file, worker_id=worker_id).run()
+
+
+class Supervisor:
+    """Runs several Consumer processes in the same Kafka consumer group.
+
+    Kafka assigns each partition of the topic to exactly one worker, and each
+    worker has its own plugin instances, so alerts are processed in parallel
+    across partitions while staying in order within a partition. Alerts with
+    the same name therefore stay in order (as TimeseriesConsumer requires) as
+    long as the producer keys messages by alert name. Workers log an error on
+    every timer if they receive alerts without a key while running such
+    plugins (see AbstractConsumer.needs_name_order).
+
+    Workers that die are restarted (after restart_delay seconds if they died
+    within restart_delay of being started). On SIGTERM or SIGINT, every
+    worker is sent SIGTERM so that it drains its plugins and commits its
+    offsets, and is killed if it has not exited within stop_timeout seconds.
+    """
+
+    def __init__(self, config_file, workers, restart_delay=5,
+                 stop_timeout=60):
+        self.config_file = os.path.expanduser(config_file)
+        self.worker_cnt = workers
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.running = False
+        # slot => (Process, start_time)
+        self.procs = {}
+        # slot => time to restart a dead worker
+        self.restart_at = {}
+        self._ctx = multiprocessing.get_context('fork')
+
+        with open(self.config_file) as fconfig:
+            config = json.loads(fconfig.read())
+        from .consumer import configure_logging
+        configure_logging(config.get('logging', 'INFO'))
+
+    def _start_worker(self, slot):
+        proc = self._ctx.Process(target=_worker_main,
+                                 args=(self.config_file, slot),
+                                 name='watchtower-alert-%d' % slot)
+        proc.start()
+        logging.info("Started worker %d (pid %d)" % (slot, proc.pid))
+        self.procs[slot] = (proc, time.time())
+
+    def shutdown(self, *args):
+        logging.info("Supervisor shutting down")
+        self.running = False
+
+    def run(self):
+        self.running = True
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+        for slot in range(self.worker_cnt):
+            self._start_worker(slot)
+        try:
+            while self.running:
+                self._check_workers()
+                time.sleep(1)
+        finally:
+            self._stop_workers()
+
+    def _check_workers(self):
+        now = time.time()
+        for slot, (proc, started) in list(self.procs.items()):
+            if proc.is_alive():
+                continue
+            if slot not in self.restart_at:
+                logging.error("Worker %d (pid %d) exited with code %s"
+                              % (slot, proc.pid, proc.exitcode))
+                # don't spin if the worker keeps dying right away
+                delay = self.restart_delay \
+                    if now - started < self.restart_delay else 0
+                self.restart_at[slot] = now + delay
+            if now >= self.restart_at[slot]:
+                del self.restart_at[slot]
+                self._start_worker(slot)
+
+    def _stop_workers(self):
+        procs = [proc for proc, _ in self.procs.values() if proc.is_alive()]
+        for proc in procs:
+            logging.info("Stopping worker pid %d" % proc.pid)
+            proc.terminate()
+        deadline = time.time() + self.stop_timeout
+        for proc in procs:
+            proc.join(max(deadline - time.time(), 0))
+            if proc.is_alive():
+                logging.error("Worker pid %d did not stop within %ds, "
+                              "killing it" % (proc.pid, self.stop_timeout))
+                proc.kill()
+                proc.join()
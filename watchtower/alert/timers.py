@@ -0,0 +1,72 @@
+import logging
+
+
+class TimerScheduler:
+    """Schedules named timers, each firing at the multiples of its own
+    interval (so a 60s timer fires at the start of every minute).
+
+    A timer is first scheduled the first time the scheduler is checked, for
+    its next multiple after that time. When checks come late (e.g. a plugin
+    stalled the main loop), every missed firing is returned, ordered by time
+    and then by the order the timers were added, so that catching up is
+    deterministic. Timers that missed more than max_catchup firings skip the
+    oldest ones.
+    """
+
+    def __init__(self, max_catchup=10):
+        self.max_catchup = max_catchup
+        # name => [interval, next firing time]
+        self.timers = {}
+        self.fired = 0
+        self.skipped = 0
+
+    def add(self, name, interval):
+        if interval <= 0:
+            raise ValueError("Timer interval for '%s' must be positive"
+                             % name)
+        self.timers[name] = [interval, None]
+
+    def next_due(self):
+        """Time the next timer is due, or None if none has been scheduled"""
+        times = [t[1] for t in self.timers.values() if t[1] is not None]
+        return min(times) if times else None
+
+    def timeout(self, now, max_timeout):
+        """How long we can wait for something else (e.g. a Kafka poll)
+        before a timer is due, at most max_timeout"""
+        next_due = self.next_due()
+        if next_due is None:
+            return max_timeout
+        return max(0, min(next_due - now, max_timeout))
+
+    def due(self, now):
+        """Return the (name, time) of every firing due by now, in order"""
+        fired = []
+        for order, (name, timer) in enumerate(self.timers.items()):
+            interval, next_time = timer
+            if next_time is None:
+                timer[1] = (int(now / interval) * interval) + interval
+                continue
+            if next_time > now:
+                continue
+            missed = int((now - next_time) / interval) + 1
+            if missed > self.max_catchup:
+                skip = missed - self.max_catchup
+                logging.warning("Timer '%s' is %ds late, skipping %d firings"
+                                % (name, now - next_time, skip))
+                self.skipped += skip
+                next_time += skip * interval
+            while next_time <= now:
+                fired.append((next_time, order, name))
+                next_time += interval
+            timer[1] = next_time
+        fired.sort()
+        self.fired += len(fired)
+        return [(name, when) for when, _, name in fired]
+
+    def stats(self):
+        return {
+            'next': {name: t[1] for name, t in self.timers.items()},
+            'fired': self.fired,
+            'skipped': self.skipped,
+        }
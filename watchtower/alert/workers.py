@@ -0,0 +1,269 @@
+import collections
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from .alert import Alert
+
+# in place of the ack of spilled alerts that are not the last of their batch
+_MID_BATCH = object()
+
+
+class PluginWorker:
+    """Runs a single consumer plugin on its own thread.
+
+    Alerts and timers are handed to the plugin through a bounded queue so
+    that a slow plugin (e.g. Slack waiting out a rate limit) does not hold up
+    the other plugins or Kafka consumption. When the queue is full, the
+    overflow policy decides what happens to new alerts:
+     - block: wait until the plugin catches up (back-pressure)
+     - drop-oldest: discard the oldest queued alert
+     - spill: append the alert to a file in spill_dir, which the worker
+       reads back once it has drained the in-memory queue
+    Timers are never dropped, since that would stall flushes. Once alerts
+    have been spilled, timers are spilled behind them, so that the plugin
+    still sees every timer after the alerts that came before it.
+
+    Alerts may be submitted with an ack (see watchtower.alert.offsets) which
+    is acknowledged once the plugin has handled (or dropped) them, or failed
+    if the plugin raised.
+    """
+
+    OVERFLOW_POLICIES = ['block', 'drop-oldest', 'spill']
+
+    defaults = {
+        'size': 1000,
+        'overflow': 'block',
+        'spill_dir': None,
+    }
+
+    def __init__(self, name, plugin, size=None, overflow=None,
+                 spill_dir=None):
+        self.name = name
+        self.plugin = plugin
+        self.size = size or self.defaults['size']
+        self.overflow = overflow or self.defaults['overflow']
+        if self.overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("Plugin queue overflow policy must be one of %s"
+                             % self.OVERFLOW_POLICIES)
+        self.spill_dir = spill_dir
+
+        # (kind, payload, enqueue_time, [acks])
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._spill_file = None
+        self._spill_read_pos = 0
+        self._spill_count = 0
+        # ack for each spilled alert (_MID_BATCH for all but the last alert
+        # of a batch, since a batch shares a single ack)
+        self._spill_acks = collections.deque()
+        self._stopping = False
+        self._thread = None
+
+        self.handled = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.errors = 0
+        self.max_depth = 0
+        # alert time of the last alert handled by the plugin
+        self.last_alert_time = None
+
+    @classmethod
+    def from_config(cls, name, plugin, config):
+        cfg = dict(cls.defaults)
+        if config:
+            cfg.update(config)
+        return cls(name, plugin, **cfg)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='plugin-%s' % self.name,
+                                        daemon=True)
+        self._thread.start()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def stop(self, timeout=None):
+        """Stop the worker once everything queued so far has been handled"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logging.error("Plugin worker '%s' did not drain within %ss"
+                              % (self.name, timeout))
+
+    def submit_alert(self, alert, ack=None):
+        self._submit('alert', alert, ack)
+
+    def submit_alerts(self, alerts, ack=None):
+        self._submit('alerts', alerts, ack)
+
+    def submit_timer(self, now):
+        with self._cond:
+            if self._spill_count:
+                self._spill('timer', now, None)
+                return
+            self._enqueue('timer', now, None)
+
+    def _submit(self, kind, payload, ack):
+        with self._cond:
+            if self.overflow == 'spill' and self._spill_count:
+                # keep alerts in order once we have started spilling
+                self._spill(kind, payload, ack)
+                return
+            while len(self._queue) >= self.size:
+                if self.overflow == 'block':
+                    self._cond.wait()
+                elif self.overflow == 'drop-oldest':
+                    if not self._drop_oldest():
+                        # the queue is full of timers, so just let this in
+                        break
+                else:
+                    self._spill(kind, payload, ack)
+                    return
+            self._enqueue(kind, payload, ack)
+
+    def _enqueue(self, kind, payload, ack):
+        # must be called with self._cond held
+        self._queue.append((kind, payload, time.time(),
+                            [ack] if ack is not None else []))
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._cond.notify_all()
+
+    def _drop_oldest(self):
+        # must be called with self._cond held
+        for i, (kind, payload, _, acks) in enumerate(self._queue):
+            if kind != 'timer':
+                del self._queue[i]
+                self.dropped += len(payload) if kind == 'alerts' else 1
+                for ack in acks:
+                    ack.ack()
+                return True
+        return False
+
+    def _spill(self, kind, payload, ack):
+        # must be called with self._cond held
+        if self._spill_file is None:
+            fd, path = tempfile.mkstemp(prefix='watchtower-%s-' % self.name,
+                                        suffix='.jsonl', dir=self.spill_dir)
+            self._spill_file = os.fdopen(fd, 'w+')
+            self._spill_read_pos = 0
+            os.unlink(path)
+        if kind == 'timer':
+            lines = [json.dumps({'timer': payload})]
+        else:
+            alerts = payload if kind == 'alerts' else [payload]
+            lines = [json.dumps(alert.as_dict()) for alert in alerts]
+            self.spilled += len(alerts)
+        self._spill_file.seek(0, os.SEEK_END)
+        for line in lines:
+            self._spill_file.write(line + "\n")
+            self._spill_acks.append(_MID_BATCH)
+        self._spill_acks[-1] = ack
+        self._spill_count += len(lines)
+        self._cond.notify_all()
+
+    def _unspill(self):
+        # must be called with self._cond held. moves about a queue's worth of
+        # spilled alerts (up to the next spilled timer, if any) back onto the
+        # (now empty) in-memory queue
+        self._spill_file.flush()
+        self._spill_file.seek(self._spill_read_pos)
+        alerts = []
+        acks = []
+        timer = None
+        read = 0
+        ack = None
+        # batches are read back whole, so that they are handled (and acked
+        # or failed) at once
+        while read < self._spill_count and \
+                (len(alerts) < self.size or ack is _MID_BATCH):
+            line = self._spill_file.readline()
+            read += 1
+            ack = self._spill_acks.popleft()
+            if ack is not None and ack is not _MID_BATCH:
+                acks.append(ack)
+            # alerts are spilled as their dict, which has no timer key
+            if line.startswith('{"timer"'):
+                timer = json.loads(line)['timer']
+                break
+            alerts.append(Alert.from_json(line))
+        self._spill_read_pos = self._spill_file.tell()
+        self._spill_count -= read
+        if not self._spill_count:
+            self._spill_file.close()
+            self._spill_file = None
+        if alerts:
+            self._queue.append(('alerts', alerts, time.time(), acks))
+        if timer is not None:
+            self._queue.append(('timer', timer, time.time(), []))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._spill_count \
+                        and not self._stopping:
+                    self._cond.wait()
+                if not self._queue:
+                    if self._spill_count:
+                        self._unspill()
+                    else:
+                        # stopping, and nothing left to do
+                        return
+                kind, payload, _, acks = self._queue.popleft()
+                self._cond.notify_all()
+            ok = self._handle(kind, payload)
+            for ack in acks:
+                if ok:
+                    ack.handled(self.plugin)
+                else:
+                    ack.fail()
+
+    def _handle(self, kind, payload):
+        """Returns False if the plugin raised"""
+        try:
+            if kind == 'alert':
+                self.plugin.handle_alert(payload)
+                self.handled += 1
+                self.last_alert_time = payload.time
+            elif kind == 'alerts':
+                self.plugin.handle_alerts(payload)
+                self.handled += len(payload)
+                self.last_alert_time = payload[-1].time
+            else:
+                self.plugin.handle_timer(payload)
+        except Exception as e:
+            self.errors += 1
+            logging.error("Plugin '%s' failed to handle %s" % (self.name,
+                                                                kind))
+            logging.exception(e)
+            return False
+        return True
+
+    def stats(self):
+        with self._cond:
+            depth = sum(len(p) if k == 'alerts' else 1
+                        for k, p, _, _ in self._queue if k != 'timer')
+            oldest = self._queue[0][2] if self._queue else None
+            spill_count = self._spill_count
+        now = time.time()
+        return {
+            'depth': depth,
+            'max_depth': self.max_depth,
+            'spill_depth': spill_count,
+            'handled': self.handled,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'errors': self.errors,
+            # how long the oldest queued item has been waiting
+            'queue_lag': now - oldest if oldest is not None else 0,
+            # how far behind real time the plugin is
+            'alert_lag': now - self.last_alert_time
+            if self.last_alert_time is not None else None,
+        }